@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+import argparse
+import glob
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Pipe, Process
+from SocketServer import ThreadingMixIn
+from threading import Thread
+
+# offline benchmarks for the crawl and query paths. runs against a corpus
+# of yednew result pages and syllabus pages: recorded ones (see `record`)
+# or synthetic ones shaped like them, replicated to 10x/100x departments.
+# network benchmarks go to a local stub server, and the fetch cache lives in
+# a temp dir, so nothing touches the real site or the real .cache.
+#
+#   python bench.py [--scale 1,10,100] [--fixtures DIR] [--only parse_yednew] [--json]
+#   python bench.py record DIR
+#
+# each benchmark runs in a forked child, so its peak memory (maxrss growth
+# over the corpus already loaded) is its own.
+
+# resolved before main() changes to the work directory
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SEMESTER_NAMES = [u'א', u'ב', u'קיץ'] * 3 + [u'שנתי'] # some rows with no known semester
+DAY_NAMES = [u'א', u'ב', u'ג', u'ד', u'ה', u'ו']
+SPANS = [('0800', '1000'), ('1000', '1200'), ('1200', '1400'), ('1400', '1600'), ('1630', '1800'), ('1800', '2000')]
+
+YEDNEW_PAGES = 5     # one full crawl: the department batches of gen_request_data
+YEDNEW_ROWS = 400
+SYLLABUS_PAGES = 20
+SYLLABUS_ROWS = 60
+
+#######################################################################
+# corpus
+
+def _noisy(cells, tag='TD'):
+    # cells with the kind of markup minify strips
+    return '<TR>%s</TR>\n' % ''.join(
+        '<%s class="c%d" bgcolor="#eeeeee" align="right" dir="rtl">%s&nbsp;</%s>' % (tag, i, c, tag)
+        for i, c in enumerate(cells)
+    )
+
+def _page(rows, header):
+    html = u'<html><head><meta charset="utf-8"></head><body>'
+    html += u'<img src="logo.gif" alt="logo"><table>' + _noisy(header, 'TH').replace('<TR>', '<TR colspan="2">')
+    html += u''.join(rows) + u'</table></body></html>'
+    return html.encode('utf-8')
+
+def yednew_page(rand, rows, copy=0):
+    # cells: semester, course, day, room, building, hours (see sources.YEDNEW_COLUMNS)
+    out = []
+    for _ in xrange(rows):
+        start, end = rand.choice(SPANS)
+        out.append(_noisy([
+            rand.choice(SEMESTER_NAMES),
+            u'<A href="/course?id=%d">%d</A>' % (rand.randint(0, 99999), rand.randint(0, 99999)),
+            rand.choice(DAY_NAMES),
+            unicode(rand.randint(1, 40) * 10 + copy * 1000),
+            u'בניין %d' % rand.randint(1, 30),
+            u'%s-%s' % (start, end),
+        ]))
+    return _page(out, [u'סמסטר', u'קורס', u'יום', u'חדר', u'בניין', u'שעה'])
+
+def syllabus_page(rand, rows, copy=0):
+    # cells: course, hours, building, room, day, lecturer, semester (see sources.SYLLABUS_COLUMNS)
+    out = []
+    for _ in xrange(rows):
+        start, end = rand.choice(SPANS)
+        out.append(_noisy([
+            unicode(rand.randint(0, 99999)),
+            u'%s - %s' % (start, end),
+            u'בניין %d' % rand.randint(1, 30),
+            unicode(rand.randint(1, 40) * 10 + copy * 1000),
+            rand.choice(DAY_NAMES),
+            u'מרצה',
+            rand.choice(SEMESTER_NAMES),
+        ]))
+    return _page(out, [u'קורס', u'שעה', u'בניין', u'חדר', u'יום', u'מרצה', u'סמסטר'])
+
+def load_corpus(scale, fixtures=None, seed=0):
+    # (yednew pages, syllabus pages) for `scale` times the departments
+    rand = random.Random(seed)
+    if fixtures:
+        yednew = [open(p, 'rb').read() for p in sorted(glob.glob(os.path.join(fixtures, 'yednew-*')))]
+        syllabus = [open(p, 'rb').read() for p in sorted(glob.glob(os.path.join(fixtures, 'syllabus-*')))]
+        return yednew * scale, syllabus * scale
+    yednew = [yednew_page(rand, YEDNEW_ROWS, copy) for copy in xrange(scale) for _ in xrange(YEDNEW_PAGES)]
+    syllabus = [syllabus_page(rand, SYLLABUS_ROWS, copy) for copy in xrange(scale) for _ in xrange(SYLLABUS_PAGES)]
+    return yednew, syllabus
+
+def record(path):
+    # saves the live pages as a fixture corpus (needs the network)
+    import sources
+    from fetch import get_session
+    session = get_session()
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for i, data in enumerate(sources.gen_request_data('', '', '')):
+        with open(os.path.join(path, 'yednew-%02d.html' % i), 'wb') as f:
+            f.write(session.post(sources.YEDNEW_URL, data=data).content)
+    for url in sources.SyllabusSource().tasks():
+        with open(os.path.join(path, 'syllabus-%s.html' % url.rsplit('=', 1)[1]), 'wb') as f:
+            f.write(session.get(url).content)
+
+#######################################################################
+# stub server: answers every request with a corpus page picked by its query
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply(body)
+
+    def do_GET(self):
+        self.reply(self.path)
+
+    def reply(self, query):
+        pages = self.server.pages
+        page = pages[hash(query) % len(pages)]
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, pages, latency=0.):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.pages = pages
+        self.latency = latency
+
+def start_stub(pages, latency=0.):
+    server = StubServer(pages, latency)
+    t = Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return 'http://127.0.0.1:%d/yed/yednew.dll' % server.server_port
+
+#######################################################################
+# benchmarks
+#
+# each takes the corpus and the options and returns (operations, bytes
+# processed). a setup function runs before the clock starts.
+
+def bench_minify(corpus, opts):
+    from sources import minify
+    for page in corpus.yednew:
+        minify(page)
+    return len(corpus.yednew), sum(map(len, corpus.yednew))
+
+def bench_parse_yednew(corpus, opts):
+    from sources import parse_yednew
+    rows = 0
+    for page in corpus.minified:
+        rows += len(parse_yednew(page))
+    return rows, sum(map(len, corpus.minified))
+
+def bench_parse_syllabus(corpus, opts):
+    from sources import parse_syllabus
+    rows = 0
+    for page in corpus.syllabus:
+        rows += len(parse_syllabus(page))
+    return rows, sum(map(len, corpus.syllabus))
+
+def bench_hours(corpus, opts):
+    from extract import hours_from_cells
+    for cells in corpus.cells:
+        hours_from_cells(cells)
+    return len(corpus.cells), 0
+
+def _index(pages):
+    # as pipeline.stream builds it, a page at a time
+    from occupancy import Occupancy
+    index = Occupancy()
+    for rows in pages:
+        index.add_rows(rows)
+    return index
+
+def bench_process(corpus, opts):
+    _index(corpus.pages)
+    return len(corpus.rows), 0
+
+def bench_free_rooms(corpus, opts):
+    # every (semester, day, hour) the interactive menus can ask for
+    from occupancy import DAYS, HOURS, SEMESTERS
+    index = _index(corpus.pages)
+    n = 0
+    for semester in SEMESTERS.values():
+        for day in DAYS.values():
+            for hour in HOURS:
+                index.free_rooms(semester, day, hour)
+                n += 1
+    return n, 0
+
+def _calls(corpus):
+    from sources import minify
+    return [
+        (corpus.url, dict(data=dict(department1=str(i), scale=str(corpus.scale)), post=True, processor=minify))
+        for i in xrange(len(corpus.yednew))
+    ]
+
+def _source():
+    from sources import Source, parse_yednew
+    source = Source(parse_yednew)
+    source.name = 'bench'
+    return source
+
+def _crawl(corpus, opts):
+    # fetch, parse and index every page, as a refresh does (pipeline.stream)
+    import pipeline
+    pipeline.stream(_source(), _calls(corpus))
+    return len(corpus.rows), sum(map(len, corpus.minified))
+
+def bench_crawl_cold(corpus, opts):
+    return _crawl(corpus, opts)
+
+def bench_crawl_warm(corpus, opts):
+    # same requests as crawl_cold: cache hits, and parse cache hits
+    return _crawl(corpus, opts)
+
+def setup_cache_lookup(corpus, opts):
+    # already cached if crawl_cold ran
+    from fetch import fetch_entry
+    for url, kwargs in _calls(corpus):
+        fetch_entry(url, **kwargs)
+
+def bench_cache_lookup(corpus, opts):
+    # fetch_entry on fresh entries: key hashing, the index and the entry read
+    from fetch import fetch_entry
+    nbytes = 0
+    calls = _calls(corpus)
+    for url, kwargs in calls:
+        nbytes += len(fetch_entry(url, **kwargs).content)
+    return len(calls), nbytes
+
+STARTUP_RUNS = 20
+
+def setup_startup(corpus, opts):
+    import main
+    from occupancy import save
+    save(_index(corpus.pages), main.OCCUPANCY_PATH)
+
+def bench_startup(corpus, opts):
+    # one-shot cli lookups answered from the snapshot, each a fresh python.
+    # the peak memory column is the bench process, not the lookups.
+    script = os.path.join(HERE, 'main.py')
+    with open(os.devnull, 'w') as devnull:
+        for _ in xrange(STARTUP_RUNS):
+            subprocess.check_call([sys.executable, script, 'free', '--semester', '1', '--day', '2', '--from', '14:15', '--to', '15:45'], stdout=devnull)
+    return STARTUP_RUNS, 0
+
+# in order: crawl_warm and cache_lookup reuse what crawl_cold cached
+BENCHMARKS = [
+    ('minify', bench_minify, None),
+    ('parse_yednew', bench_parse_yednew, None),
+    ('parse_syllabus', bench_parse_syllabus, None),
+    ('hours', bench_hours, None),
+    ('process', bench_process, None),
+    ('free_rooms', bench_free_rooms, None),
+    ('crawl_cold', bench_crawl_cold, None),
+    ('crawl_warm', bench_crawl_warm, None),
+    ('cache_lookup', bench_cache_lookup, setup_cache_lookup),
+    ('startup', bench_startup, setup_startup),
+]
+
+class Corpus(object):
+
+    def __init__(self, scale, fixtures=None):
+        import main # imported before the children fork, so they don't time it
+        import occupancy
+        occupancy.import_numpy()
+        from extract import iter_rows
+        from sources import minify, parse_yednew
+        self.scale = scale
+        self.yednew, self.syllabus = load_corpus(scale, fixtures)
+        self.minified = [minify(page) for page in self.yednew]
+        self.cells = [cells for page in self.minified for cells in iter_rows(page)]
+        self.pages = [parse_yednew(page) for page in self.minified]
+        self.rows = [row for page in self.pages for row in page]
+        self.url = None # of the stub server, see run()
+
+def _maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kb on linux
+
+def _child(conn, bench, setup, corpus, opts):
+    if setup:
+        setup(corpus, opts)
+    base = _maxrss()
+    start = time.time()
+    ops, nbytes = bench(corpus, opts)
+    elapsed = time.time() - start
+    conn.send((elapsed, ops, nbytes, _maxrss() - base))
+
+def run_one(bench, setup, corpus, opts):
+    parent, child = Pipe()
+    p = Process(target=_child, args=(child, bench, setup, corpus, opts))
+    p.start()
+    deadline = time.time() + opts.timeout
+    while not parent.poll(0.1):
+        if not p.is_alive() or time.time() > deadline:
+            p.terminate()
+            return
+    result = parent.recv()
+    p.join()
+    return result
+
+def run(opts):
+    results = []
+    for scale in opts.scale:
+        corpus = Corpus(scale, opts.fixtures)
+        # one stub for all the children, so they share cache keys
+        corpus.url = start_stub(corpus.yednew, opts.latency)
+        for name, bench, setup in BENCHMARKS:
+            if opts.only and name not in opts.only:
+                continue
+            best = None
+            for _ in xrange(opts.repeat if not name.startswith('crawl') else 1):
+                result = run_one(bench, setup, corpus, opts)
+                if result and (best is None or result[0] < best[0]):
+                    best = result
+            if best is None:
+                print >> sys.stderr, '%s x%d: failed' % (name, scale)
+                continue
+            elapsed, ops, nbytes, peak = best
+            results.append(dict(
+                name = name,
+                scale = scale,
+                seconds = elapsed,
+                ops = ops,
+                ops_per_s = ops / elapsed if elapsed else 0,
+                mb_per_s = nbytes / elapsed / 1e6 if elapsed else 0,
+                peak_mb = peak / 1e6,
+            ))
+            if not opts.json:
+                print_result(results[-1])
+    if opts.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    return results
+
+def print_result(r):
+    print '%-14s x%-4d %10d ops %9.3fs %12.0f ops/s %8.1f MB/s %8.1f MB peak' % (
+        r['name'], r['scale'], r['ops'], r['seconds'], r['ops_per_s'], r['mb_per_s'], r['peak_mb'])
+    sys.stdout.flush()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='offline benchmarks; "record DIR" saves live pages as fixtures')
+    parser.add_argument('--scale', default='1,10', type=lambda s: [int(n) for n in s.split(',')], help='department multipliers, e.g. 1,10,100')
+    parser.add_argument('--fixtures', help='a directory from `record`, instead of synthetic pages')
+    parser.add_argument('--only', type=lambda s: s.split(','), help='comma separated benchmark names')
+    parser.add_argument('--repeat', default=3, type=int, help='runs per benchmark, the best is reported')
+    parser.add_argument('--latency', default=0., type=float, help='stub server delay per request, in seconds')
+    parser.add_argument('--timeout', default=600, type=int, help='seconds before a benchmark is given up')
+    parser.add_argument('--json', action='store_true')
+    return parser.parse_args(argv)
+
+def main(argv):
+    if argv[:1] == ['record']:
+        return record(os.path.abspath(argv[1]))
+    opts = parse_args(argv)
+    if opts.fixtures:
+        opts.fixtures = os.path.abspath(opts.fixtures)
+    # fetch keeps its cache in the working directory
+    workdir = tempfile.mkdtemp(prefix='gilman-bench-')
+    os.chdir(workdir)
+    try:
+        run(opts)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,233 @@
+import signal
+
+from multiprocessing import Pool
+from threading import Condition, Event, Thread, active_count
+from Queue import Queue, Empty, Full
+
+import fetch
+from extract import get_parsed, put_parsed
+from fetch import fetch_entry, is_cached
+
+#######################################################################
+# adaptive concurrency
+
+class AdaptiveLimit(object):
+    # aimd limit on concurrent network fetches: every `window` fetches the
+    # limit grows by one if they were fast and mostly ok, and is halved if
+    # the error rate or the latency (against the best window seen) went up.
+    # a failed fetch has no latency, it only counts as an error.
+
+    def __init__(self, initial, minimum=1, maximum=32, window=8, max_error_rate=0.1, max_slowdown=2.):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.max_slowdown = max_slowdown
+        self.active = 0
+        self.baseline = None
+        self.samples = []
+        self.cond = Condition()
+
+    def acquire(self, cancelled):
+        with self.cond:
+            while self.active >= self.limit:
+                if cancelled.is_set():
+                    return False
+                self.cond.wait(0.1)
+            self.active += 1
+            return True
+
+    def release(self, latency, ok):
+        with self.cond:
+            self.active -= 1
+            self.samples.append((latency, ok))
+            if len(self.samples) >= self.window:
+                self.adjust()
+            self.cond.notify_all()
+
+    def adjust(self):
+        latencies = [l for l, _ in self.samples if l]
+        latency = sum(latencies) / len(latencies) if latencies else None
+        error_rate = sum(1. for _, ok in self.samples if not ok) / len(self.samples)
+        self.samples = []
+        if latency is not None and (self.baseline is None or latency < self.baseline):
+            self.baseline = latency
+        slow = latency is not None and latency > self.baseline * self.max_slowdown
+        if error_rate > self.max_error_rate or slow:
+            self.limit = max(self.minimum, self.limit // 2)
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+
+#######################################################################
+# crawler
+
+class Crawler(object):
+    # fetches tasks with a pool of worker threads and hands the responses
+    # to separate parse workers, so parsing never holds a fetch slot.
+    # results are yielded in completion order.
+    #
+    # a task is either a url or a (url, fetch kwargs) pair.
+    #
+    # parse results are cached by page content (see extract.get_parsed),
+    # so only pages that changed since the last crawl are parsed.
+    #
+    # with parse_processes, parsing runs in a process pool instead of threads
+    # (parsing is cpu bound and threads serialize on the gil). the parser then
+    # has to be a module level function, and its results picklable. the pool
+    # is only used from a single threaded process: a child forked while
+    # another thread holds a lock (say, the server's handlers in instrument)
+    # starts with it held for good. otherwise parsing stays in threads.
+    #
+    # at most max_pending pages are between being fetched and being taken by
+    # the caller: a fetch worker waits for a slot before it starts a task, so
+    # a slow consumer holds the fetching back rather than piling up pages.
+    #
+    # max_workers is capped at fetch.max_connections, the connections the
+    # session keeps per host: past them, each request opens one of its own.
+
+    MAX_WORKERS = 32
+    INITIAL_WORKERS = 8
+    PARSE_WORKERS = 2
+    MAX_PENDING = 64
+
+    def __init__(self, parser, max_workers=None, initial_workers=None, parse_workers=None, parse_processes=0, max_pending=None):
+        self.parser = parser
+        self.max_workers = min(max_workers or self.MAX_WORKERS, fetch.max_connections)
+        self.parse_workers = parse_workers or self.PARSE_WORKERS
+        self.parse_processes = parse_processes
+        self.pool = None
+        self.limit = AdaptiveLimit(
+            initial = min(initial_workers or self.INITIAL_WORKERS, self.max_workers),
+            maximum = self.max_workers,
+        )
+        self.cancelled = Event()
+        self.pending = Queue(max_pending or self.MAX_PENDING) # a slot per page in flight
+        self.tasks = Queue()
+        self.parse_q = Queue()
+        self.done = Queue()
+
+    def crawl(self, tasks):
+        # yields (task, parsed) pairs; parsed is None if the fetch failed
+        tasks = list(tasks)
+        for task in tasks:
+            self.tasks.put(task)
+        if self.parse_processes and active_count() == 1:
+            # fork before starting any threads
+            self.pool = Pool(self.parse_processes, initializer=_ignore_sigint)
+        threads = [Thread(target=self.fetch_worker) for _ in xrange(min(self.max_workers, len(tasks)))]
+        if not self.pool:
+            threads += [Thread(target=self.parse_worker) for _ in xrange(self.parse_workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            for _ in xrange(len(tasks)):
+                task, parsed, fetched, fresh = self.wait_for_result()
+                self.pending.get_nowait()
+                if isinstance(parsed, Exception):
+                    raise parsed
+                if fresh and parsed is not None:
+                    put_parsed(self.parser, fetched.digest, parsed)
+                yield task, parsed
+        except BaseException:
+            # ctrl-c, a parse error, or the caller stopped iterating
+            self.cancel()
+            raise
+        finally:
+            if self.pool:
+                self.pool.terminate()
+                self.pool = None
+            for _ in xrange(self.parse_workers):
+                self.parse_q.put(None)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait_for_result(self):
+        # short timeouts keep the wait interruptible by ctrl-c
+        while True:
+            try:
+                return self.done.get(timeout=0.5)
+            except Empty:
+                pass
+
+    def take_slot(self):
+        # short timeouts keep the wait interruptible by cancel()
+        while not self.cancelled.is_set():
+            try:
+                self.pending.put(None, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def fetch_worker(self):
+        while self.take_slot():
+            try:
+                task = self.tasks.get_nowait()
+            except Empty:
+                self.pending.get_nowait()
+                return
+            try:
+                if not self.fetch_task(task):
+                    self.pending.get_nowait()
+                    return
+            except Exception:
+                # every task gets a result, or crawl() would wait for it forever
+                self.done.put((task, None, None, False))
+
+    def fetch_task(self, task):
+        # returns False if cancelled while waiting for a fetch slot
+        url, kwargs = task if isinstance(task, tuple) else (task, {})
+        if is_cached(url, *cache_key_args(kwargs)):
+            # cache hits are not limited nor measured
+            self.submit_parse(task, fetch_entry(url, **kwargs))
+            return True
+        if not self.limit.acquire(self.cancelled):
+            return False
+        fetched = None
+        try:
+            fetched = fetch_entry(url, **kwargs)
+        except Exception:
+            pass # counted as an error below
+        # the time on the network, not waiting on the rate limit or backing off
+        self.limit.release(fetched and fetched.network, fetched is not None)
+        self.submit_parse(task, fetched)
+        return True
+
+    def submit_parse(self, task, fetched):
+        if fetched is None or self.cancelled.is_set():
+            self.done.put((task, None, None, False))
+            return
+        parsed = get_parsed(self.parser, fetched.digest)
+        if parsed is not None:
+            self.done.put((task, parsed, fetched, False))
+        elif self.pool:
+            callback = lambda parsed: self.done.put((task, parsed, fetched, True))
+            self.pool.apply_async(_parse, (self.parser, fetched.content), callback=callback)
+        else:
+            self.parse_q.put((task, fetched))
+
+    def parse_worker(self):
+        while True:
+            item = self.parse_q.get()
+            if item is None:
+                return
+            task, fetched = item
+            self.done.put((task, _parse(self.parser, fetched.content), fetched, True))
+
+def _parse(parser, content):
+    try:
+        return parser(content)
+    except Exception as e:
+        return e # re-raised by crawl()
+
+def _ignore_sigint():
+    # ctrl-c is handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def cache_key_args(kwargs):
+    if kwargs.get('post'):
+        return kwargs.get('data'), 'POST'
+    return kwargs.get('params'), 'GET'
@@ -0,0 +1,192 @@
+import json
+import re
+import sys
+
+from collections import namedtuple
+from HTMLParser import HTMLParser
+
+import instrument
+
+from fetch import cache, get_from_cache
+
+# a parsed schedule row: one room taken during `hours` (e.g. ('1000', '1200'))
+# on a day of a semester
+Row = namedtuple('Row', 'building room day hours semester')
+
+# fast table scanner: walks the <tr>/<td> tags of a page with one compiled
+# regex and yields the text of each row's cells, without building a tree.
+# it assumes flat tables (which is what the schedule pages have); the bs4
+# path is kept as a fallback and as the reference for check_parity.
+
+_TAG = re.compile(r'<(/?)(tr|td|th|table)\b[^>]*>', re.I)
+_ANY_TAG = re.compile(r'<[^>]*>')
+_CHARSET = re.compile(r'charset=["\']?([\w-]+)', re.I)
+_unescape = HTMLParser().unescape
+
+def decode(response):
+    if isinstance(response, unicode):
+        return response
+    match = _CHARSET.search(response, 0, 2048)
+    if match:
+        try:
+            return response.decode(match.group(1), 'replace')
+        except LookupError:
+            pass
+    try:
+        return response.decode('utf-8')
+    except UnicodeDecodeError:
+        return response.decode('windows-1255', 'replace')
+
+def cell_text(html):
+    text = _ANY_TAG.sub('', html)
+    return _unescape(text) if '&' in text else text
+
+def iter_rows(response):
+    # yields a list of td texts per <tr>, like [td.text for td in tr.findAll('td')]
+    response = decode(response)
+    row = None
+    cell = None # (start, is_td) of the open cell
+    for m in _TAG.finditer(response):
+        closing, tag = m.group(1), m.group(2).lower()
+        if cell is not None:
+            # any row/cell/table tag ends the open cell
+            start, is_td = cell
+            if is_td:
+                row.append(cell_text(response[start:m.start()]))
+            cell = None
+        if tag in ('td', 'th'):
+            if not closing and row is not None:
+                cell = (m.end(), tag == 'td')
+        elif tag == 'tr' or closing:
+            # a new row or a closing tr/table ends the open row
+            if row is not None:
+                yield row
+            row = [] if tag == 'tr' and not closing else None
+    if row is not None:
+        if cell is not None and cell[1]:
+            row.append(cell_text(response[cell[0]:]))
+        yield row
+
+def soup_rows(response):
+    from bs4 import BeautifulSoup as bsoup # only the fallback needs it
+    for tr in bsoup(response).findAll('tr'):
+        yield [td.text for td in tr.findAll('td')]
+
+#######################################################################
+# schedule tables: both endpoints list one meeting per row, with the hours
+# as 'hhmm-hhmm' in some cell and the other fields at fixed columns
+
+use_fast_parser = True # False falls back to bs4
+
+_HOURS = re.compile(r'\d{4} *- *\d{4}')
+_SEP = u'\x00' # joins a row's cells; no span can match across it
+
+# span as matched, e.g. '1000 - 1200' -> ('1000', '1200'), or None if it is
+# outside teaching hours. a term has a few dozen distinct spans, so each is
+# split and checked once.
+_spans = {}
+
+def parse_span(text):
+    try:
+        return _spans[text]
+    except KeyError:
+        hours = tuple(h.strip() for h in text.split('-'))
+        span = _spans[text] = hours if all('0700' < h < '2100' for h in hours) else None
+        return span
+
+def hours_from_cells(cells):
+    # the first span within teaching hours, e.g. ('1000', '1200'), looking
+    # at the first span of each cell. one search over the joined cells
+    # instead of one per cell.
+    text = _SEP.join(cells)
+    pos = 0
+    while True:
+        match = _HOURS.search(text, pos)
+        if match is None:
+            return
+        span = parse_span(match.group())
+        if span:
+            return span
+        pos = text.find(_SEP, match.end()) + 1
+        if not pos:
+            return
+
+def classify_rows(rows, width):
+    # (cells, hours) for each row of a table that has a cell at index width
+    # and a span within teaching hours, in one pass
+    return [(cells, hours) for cells, hours in ((cells, hours_from_cells(cells)) for cells in rows if len(cells) > width) if hours]
+
+def parse_table(response, columns, fast=None):
+    # columns: cell index of the building, room, day and semester
+    if fast is None:
+        fast = use_fast_parser
+    b, r, d, s = columns['building'], columns['room'], columns['day'], columns['semester']
+    rows = []
+    for cells, hours in classify_rows(iter_rows(response) if fast else soup_rows(response), max(b, r, d, s)):
+        building = cells[b].strip()
+        room = cells[r].strip()
+        if building and room:
+            rows.append(Row(building, room, cells[d].strip(), hours, cells[s].strip()))
+    return rows
+
+#######################################################################
+# parse results, cached by page content, so pages that did not change since
+# the last fetch are not parsed again. they are kept as json, not pickles:
+# the cache can be a store shared between hosts, and loading a pickle from
+# it would run whatever code whoever can write to it put there.
+
+PARSE_VERSION = 2 # bump when a parser or the format changes, to drop cached rows
+
+def _parsed_key(parser, digest):
+    return 'parsed:%s:%d:%s' % (parser.__name__, PARSE_VERSION, digest)
+
+def get_parsed(parser, digest):
+    cached = get_from_cache(_parsed_key(parser, digest), None, 'PARSE')
+    if cached is not None:
+        try:
+            rows = [Row(building, room, day, tuple(hours), semester) for building, room, day, hours, semester in json.loads(cached)]
+        except (ValueError, TypeError):
+            return # not rows after all; parsed again
+        instrument.count('parse.cached')
+        return rows
+
+def put_parsed(parser, digest, rows):
+    cache(_parsed_key(parser, digest), None, json.dumps(rows), 'PARSE')
+
+#######################################################################
+# parity check
+
+def check_parity(responses, parser):
+    # parser(response, fast=...) is run both ways on each response; returns
+    # the indices of the responses where the results differ
+    return [i for i, response in enumerate(responses) if parser(response, fast=True) != parser(response, fast=False)]
+
+def check_fixtures(path):
+    # the pages saved in path (see `python bench.py record`), named as bench
+    # loads them; yednew pages are minified first, as the crawl does. returns
+    # (mismatched paths, number of pages)
+    import glob, os
+    import sources
+    checks = [
+        ('yednew-*', sources.parse_yednew, sources.minify),
+        ('syllabus-*', sources.parse_syllabus, None),
+    ]
+    mismatched, n = [], 0
+    for pattern, parser, processor in checks:
+        paths = sorted(glob.glob(os.path.join(path, pattern)))
+        responses = [open(p, 'rb').read() for p in paths]
+        if processor:
+            responses = [processor(response) for response in responses]
+        mismatched += [paths[i] for i in check_parity(responses, parser)]
+        n += len(paths)
+    return mismatched, n
+
+if __name__ == '__main__':
+    # usage: python extract.py [DIR]
+    # checks the committed fixtures by default, or e.g. a recorded corpus
+    import os
+    mismatched, n = check_fixtures(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+    for path in mismatched:
+        print 'mismatch:', path
+    print '%d/%d pages match' % (n - len(mismatched), n)
+    sys.exit(1 if mismatched or not n else 0)
@@ -1,110 +1,786 @@
+import fcntl
+import hashlib
 import os
+import random
 import re
-import requests
+import tempfile
 import time
+import urllib
 import urlparse
+import zlib
 
-from datetime import datetime, timedelta
+import instrument
+from stores import Entry, RedisStore, SqliteStore, Store, StoreError
 
-session = requests.Session()
-session.headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/49.0.2623.87 Safari/537.36'
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+from threading import Event, Lock, RLock
+
+max_hosts = 16       # hosts the session keeps connections to
+max_connections = 32 # connections kept open per host, one per crawl.Crawler fetch worker
+
+# requests, the session and the cache directory are set up on first use, so
+# answering from the occupancy snapshot never imports or touches them
+session = None
+_session_lock = Lock()
+
+def get_session():
+    global session
+    with _session_lock:
+        if session is None:
+            import requests
+            s = requests.Session()
+            s.headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/49.0.2623.87 Safari/537.36'
+            # keep up to max_connections open connections per host for reuse
+            # across threads; a thread past them opens one and drops it after
+            for prefix in ('http://', 'https://'):
+                s.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=max_hosts, pool_maxsize=max_connections))
+            session = s
+        return session
 
 #######################################################################
 # cache
 
 use_cache = True
-cache_max_age = timedelta(days=40)
+cache_backend = 'local' # a STORES name
+cache_url = None        # the sqlite file or redis url, None for the store's default
+cache_max_age = timedelta(days=40)  # default ttl for new entries
+cache_max_bytes = 512 * 1024 * 1024 # lru eviction kicks in above this
+cache_low_water = 0.9 # and frees the cache down to this share of it
+cache_grace = timedelta(days=30)    # expired entries with validators are kept this long, to revalidate
+sweep_interval = 3600 # seconds between sweeps of entries past their use, whatever the size
+cache_compression = 'zlib' # a CODECS name, or '' to store entries as they are
+cache_segments = False      # pack entries into shared append-only segment files
+segment_max_bytes = 64 * 1024 * 1024
 cache_dir = '.cache'
 metafile = '%s/%s' % (cache_dir, '.metadata')
+lockfile = '%s/%s' % (cache_dir, '.lock')
 sep = ' # '
 
-if not os.path.exists(cache_dir):
-    os.makedirs(cache_dir)
-if not os.path.exists(metafile):
-    open(metafile,'a').close()
-
-def create_entry_path(entry):
-    with open(metafile, 'a+') as f:
-        lines = f.read().splitlines()
-        name = int(lines[-1].split(sep)[-1])+1 if lines else 0
-        f.write('%s%s%s\n' % (entry, sep, name))
-        return '%s/%s' % (cache_dir, name)
-
-def get_entry_path(entry, create=False):
-    sep = ' # '
-    lookfor = '%s%s' % (entry, sep)
+# name -> (compress, decompress)
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+try:
+    import zstandard
+    # compressor objects are not thread safe, so one per call
+    CODECS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+except ImportError:
+    pass
+
+def _ensure_cache_dir():
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass # made by another process meanwhile
+    if not os.path.exists(metafile):
+        open(metafile,'a').close()
+
+# the local store (the default) keeps entries in files under cache_dir.
+#
+# the metadata file is an append-only log of
+# "key # name # stored # ttl # size # etag # last modified # content sha1 # codec # offset"
+# lines; it is read once into an in-memory index (last line per key wins) and
+# new entries are appended to it. the index is kept in lru order: hits move
+# an entry to the end, eviction pops from the front. etag and last modified
+# are the validators the server sent, for conditional refreshes. evicted
+# keys get a "key # -" line, and the log is only compacted once most of its
+# lines are dead.
+#
+# lines in the old "entry # name" format (keyed by the mangled url and
+# params, see _legacy_key) load as entries stored when their file was
+# written, with the default ttl and no digest. the first time a request
+# misses, its old entry moves to the hashed key (see migrate); the ones
+# never asked for again expire and are swept like any other.
+#
+# an entry is stored in the file `name`, or, when offset is not -1, as `size`
+# bytes at `offset` of the segment file `name`. size is the stored (maybe
+# compressed) size, and codec is what it was compressed with, if anything.
+# (Entry is in stores.py, shared with the other stores.)
+
+# several processes can share the cache: changes to the log happen under an
+# exclusive flock on the lock file, after catching up with whatever other
+# processes appended to it (or reloading it, if one of them compacted it).
+# plain lookups only use the in-memory index.
+
+_index = None
+_next_name = 0
+_total_bytes = 0
+_index_lock = RLock()
+_log_pos = 0    # how far into the log the in-memory index is
+_log_lines = 0  # lines in the log, live or not
+_log_ino = None # inode of the log, which changes when it's compacted
+_lock_file = None
+_lock_depth = 0
+
+def _parse_entry(line):
+    # (key, None) for an evicted key
+    parts = line.split(sep)
+    if len(parts) == 2 and parts[1] == '-':
+        return parts[0], None
+    if len(parts) == 2 and parts[1].isdigit():
+        # legacy format
+        try:
+            st = os.stat('%s/%s' % (cache_dir, parts[1]))
+        except OSError:
+            return parts[0], None
+        return parts[0], Entry(parts[1], st.st_mtime, _ttl_seconds(None), st.st_size, '', '', '', '', -1)
+    if len(parts) in (5, 8, 10) and parts[1].isdigit():
+        # lines from older versions lack the later fields
+        parts += ['', '', '', '', '-1'][len(parts) - 5:]
+        key, name, stored, ttl, size, etag, modified, digest, codec, offset = parts
+        return key, Entry(name, float(stored), float(ttl), int(size), etag, modified, digest, codec, int(offset))
+    return None, None
+
+def _format_entry(key, e):
+    fields = (key, e.name, '%.0f' % e.stored, '%.0f' % e.ttl, str(e.size), e.etag, e.modified, e.digest, e.codec, str(e.offset))
+    return sep.join(fields) + '\n'
+
+def load_index():
+    global _index, _next_name, _total_bytes, _log_pos, _log_ino, _log_lines
+    with _index_lock:
+        _ensure_cache_dir()
+        _index, _next_name, _total_bytes, _log_lines = OrderedDict(), 0, 0, 0
+        _log_ino = os.stat(metafile).st_ino
+        _log_pos = _read_log(_index, 0)
+        return _index
+
+def _read_log(index, start):
+    # applies the log from byte `start` on to the index, and returns where it
+    # stopped (before a partly written last line, if any)
+    global _next_name, _total_bytes, _log_lines
     with open(metafile) as f:
-        for line in f.read().splitlines():
-            if line.startswith(lookfor):
-                name = line.split(sep)[-1]
-                return '%s/%s' % (cache_dir, name)
-    # not found
-    if create:
-        return create_entry_path(entry)
-
-def to_entry(url, params):
-    url = re.sub('[^\w\s-]', '', url)
-    params = params_to_string(params)
-    return '%s%s' % (url, params)
-
-def build_path(url, params, create=False):
-    return get_entry_path(to_entry(url, params), create=create)
-
-def params_to_string(params):
-    name = ''
-    if params:
-        for k, v in params.iteritems():
-            name += '%s%s' % (k, v)
-    return name
-
-def is_cached(url, params):
-    if not use_cache:
-        return False
-    path = build_path(url, params)
-    if path and os.path.exists(path):
-        age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(path))
-        if age < cache_max_age:
-            return True
-    return False
-
-def get_from_cache(url, params):
-    if is_cached(url, params):
-        path = build_path(url, params)
-        with open(path) as cached:
+        f.seek(start)
+        data = f.read()
+    end = data.rfind('\n') + 1
+    for line in data[:end].splitlines():
+        _log_lines += 1
+        key, e = _parse_entry(line)
+        if key is None:
+            continue
+        old = index.pop(key, None)
+        if old is not None:
+            _total_bytes -= old.size
+        if e is None:
+            continue
+        index[key] = e
+        _total_bytes += e.size
+        _next_name = max(_next_name, int(e.name)+1)
+    return start + end
+
+def _sync_index():
+    global _log_pos
+    if _index is None or os.stat(metafile).st_ino != _log_ino:
+        return load_index()
+    _log_pos = _read_log(_index, _log_pos)
+    return _index
+
+@contextmanager
+def _locked_index():
+    # yields the index, up to date and locked against other threads and processes
+    global _lock_file, _lock_depth
+    with _index_lock:
+        if _lock_file is None:
+            _ensure_cache_dir()
+            _lock_file = open(lockfile, 'a')
+        if not _lock_depth:
+            fcntl.flock(_lock_file, fcntl.LOCK_EX)
+        _lock_depth += 1
+        try:
+            yield _sync_index() if _lock_depth == 1 else _index
+        finally:
+            _lock_depth -= 1
+            if not _lock_depth:
+                fcntl.flock(_lock_file, fcntl.LOCK_UN)
+
+def _append_log(key, e):
+    _append_lines([_format_entry(key, e)])
+
+def _append_lines(lines):
+    global _log_pos, _log_lines
+    with open(metafile, 'a') as f:
+        f.write(''.join(lines))
+        _log_pos = f.tell()
+    _log_lines += len(lines)
+
+def get_index():
+    return _index if _index is not None else load_index()
+
+def compact_index():
+    # rewrite the metadata log from the in-memory index (in lru order)
+    global _log_pos, _log_ino, _log_lines
+    with _locked_index() as index:
+        tmp = metafile + '.tmp'
+        with open(tmp, 'w') as f:
+            for key, e in index.iteritems():
+                f.write(_format_entry(key, e))
+            _log_pos = f.tell()
+        _log_lines = len(index)
+        os.rename(tmp, metafile)
+        _log_ino = os.stat(metafile).st_ino
+
+def _entry_path(e):
+    return '%s/%s' % (cache_dir, e.name)
+
+def _is_fresh(e, now=None):
+    return (now or time.time()) < e.stored + e.ttl
+
+def _is_spent(e, grace, now):
+    # past any use: expired, and past the grace period too if it has
+    # validators to revalidate it with
+    return now >= e.stored + e.ttl + (grace if e.etag or e.modified else 0)
+
+def to_entry(url, params, method='GET'):
+    # stable key: method + url + params sorted by name
+    if hasattr(params, 'items'):
+        params = params.items()
+    query = urllib.urlencode(sorted(params or []))
+    return hashlib.sha1('%s %s?%s' % (method.upper(), url, query)).hexdigest()
+
+def get_entry(key):
+    with _index_lock:
+        index = get_index()
+        e = index.pop(key, None)
+        if e is not None:
+            index[key] = e
+        return e
+
+def _new_name():
+    # a file name no entry has used, under _locked_index
+    global _next_name
+    _next_name += 1
+    return str(_next_name - 1)
+
+def put_entry(key, size, ttl=None, etag='', modified='', digest='', codec='', name=None, offset=-1, stored=None):
+    # name defaults to the entry's current file (or a new one), stored to now
+    global _total_bytes
+    if ttl is None:
+        ttl = cache_max_age
+    if isinstance(ttl, timedelta):
+        ttl = ttl.total_seconds()
+    with _locked_index() as index:
+        old = index.pop(key, None)
+        if old is not None:
+            _total_bytes -= old.size
+        if name is None:
+            if old is not None and old.offset == -1:
+                name = old.name
+            else:
+                name = _new_name()
+        e = index[key] = Entry(name, stored or time.time(), ttl, size, etag or '', modified or '', digest, codec, offset)
+        _total_bytes += size
+        _append_log(key, e)
+        return e
+
+def evict(max_bytes=None, grace=None):
+    # drop spent entries (see _is_spent), then, with max_bytes, least
+    # recently used ones until the cache fits in it. returns the number of
+    # evicted entries.
+    global _total_bytes
+    if grace is None:
+        grace = _ttl_seconds(cache_grace)
+    with _locked_index() as index:
+        now = time.time()
+        evicted = [k for k, e in index.iteritems() if _is_spent(e, grace, now)]
+        segments = set()
+        for key in evicted:
+            _remove(index.pop(key), segments)
+        while max_bytes is not None and _total_bytes > max_bytes and index:
+            key, e = index.popitem(last=False)
+            _remove(e, segments)
+            evicted.append(key)
+        if evicted:
+            _append_lines(['%s%s-\n' % (key, sep) for key in evicted])
+            if _log_lines - len(index) > max(len(index), 1000):
+                compact_index()
+        # segments are only deleted once none of their entries are left.
+        # eviction goes oldest first, and so do segments, so they mostly
+        # empty out whole.
+        live = set(e.name for e in index.itervalues() if e.offset != -1)
+        if _segment:
+            live.add(_segment[0])
+        for name in segments - live:
+            _remove_file(name)
+        return len(evicted)
+
+def _legacy_key(url, params):
+    # the key of the request in the old format, params in their order
+    params = ''.join('%s%s' % kv for kv in params.iteritems()) if params else ''
+    return '%s%s' % (re.sub('[^\w\s-]', '', url), params)
+
+def migrate(key, old_key):
+    # moves the fresh legacy entry under old_key, if there is one, to key.
+    # returns the new entry
+    global _total_bytes
+    with _index_lock:
+        index = get_index()
+        if key in index or old_key not in index:
+            return
+    with _locked_index() as index:
+        e = index.get(old_key)
+        if key in index or e is None or e.digest or not _is_fresh(e):
+            return
+        try:
+            digest = hashlib.sha1(_read_file(e)).hexdigest()
+        except IOError:
+            return
+        del index[old_key]
+        _total_bytes -= e.size
+        _append_lines(['%s%s-\n' % (old_key, sep)])
+        return put_entry(key, e.size, e.ttl, digest=digest, name=e.name, stored=e.stored)
+
+def _remove(e, segments):
+    global _total_bytes
+    _total_bytes -= e.size
+    if e.offset == -1:
+        _remove_file(e.name)
+    else:
+        segments.add(e.name)
+
+def _remove_file(name):
+    try:
+        os.remove('%s/%s' % (cache_dir, name))
+    except OSError:
+        pass
+
+def _read_file(e):
+    with open(_entry_path(e), 'rb') as cached:
+        if e.offset == -1:
             return cached.read()
+        cached.seek(e.offset)
+        return cached.read(e.size)
+
+_segment = None # [name, size] of the segment currently appended to
+
+def _append_to_segment(data):
+    # returns the (segment name, offset) data was written at
+    global _segment
+    with _locked_index():
+        if _segment is None or _segment[1] + len(data) > segment_max_bytes:
+            _segment = [_new_name(), 0]
+        name, offset = _segment
+        with open('%s/%s' % (cache_dir, name), 'ab') as f:
+            f.write(data)
+        _segment[1] += len(data)
+        return name, offset
+
+class LocalStore(Store):
+    # the cache directory above
+
+    name = 'local'
+
+    def get(self, key):
+        e = get_entry(key)
+        if e and os.path.exists(_entry_path(e)):
+            return e
+
+    def read(self, key, e):
+        return _read_file(e)
+
+    def put(self, key, data, ttl, etag, modified, digest, codec):
+        if cache_segments:
+            # one lock, so no other process can take the segment's name meanwhile
+            with _locked_index():
+                name, offset = _append_to_segment(data)
+                return put_entry(key, len(data), ttl, etag, modified, digest, codec, name, offset)
+        # the data is in place, under a new name, before the log line that
+        # points to it: another process never finds the new entry (and its
+        # digest) with the old data. the old file goes after.
+        _ensure_cache_dir()
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        with _locked_index() as index:
+            old = index.get(key)
+            name = _new_name()
+            os.rename(tmp, '%s/%s' % (cache_dir, name))
+            e = put_entry(key, len(data), ttl, etag, modified, digest, codec, name)
+        if old is not None and old.offset == -1:
+            _remove_file(old.name)
+        return e
+
+    def renew(self, key, e, ttl):
+        return put_entry(key, e.size, ttl, e.etag, e.modified, e.digest, e.codec, e.name, e.offset)
+
+    def drop(self, key, e):
+        # expired, without validators, so the next fetch downloads it whole;
+        # the data goes with the next sweep
+        put_entry(key, e.size, 0, '', '', '', e.codec, e.name, e.offset)
+
+    def evict(self, max_bytes, grace):
+        return evict(max_bytes, grace)
+
+    def total_bytes(self):
+        return _total_bytes
+
+#######################################################################
+# cache backends
+#
+# lookups and stores go through the store picked by cache_backend (see
+# stores.py). each store's hits, misses, stores, bytes and errors are
+# counted as cache.<backend>.* in instrument.
+
+STORES = dict((store.name, store) for store in (LocalStore, SqliteStore, RedisStore))
+
+_store = None
+_store_lock = Lock()
 
-def cache(url, params, content):
-    path = build_path(url, params, create=True)
-    with open(path, 'w') as out:
-       out.write(content)
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = STORES[cache_backend](*([cache_url] if cache_url and cache_backend != 'local' else []))
+        return _store
+
+def set_store(backend, url=None):
+    # switches backends; url is the sqlite file or redis url
+    global cache_backend, cache_url, _store
+    if backend not in STORES:
+        raise ValueError('unknown cache backend: %s' % backend)
+    with _store_lock:
+        cache_backend, cache_url, _store = backend, url, None
+
+def _ttl_seconds(ttl):
+    if ttl is None:
+        ttl = cache_max_age
+    return ttl.total_seconds() if isinstance(ttl, timedelta) else ttl
+
+def _stored_entry(key):
+    # the entry for key, fresh or not; a failing store is a miss
+    store = get_store()
+    try:
+        return store.get(key)
+    except StoreError:
+        instrument.count('cache.%s.errors' % store.name)
+
+def _fresh_entry(key):
+    if not use_cache:
+        return
+    e = _stored_entry(key)
+    if e and _is_fresh(e):
+        return e
+
+def _request_key(url, params, method):
+    # the request's key, after moving its entry from the old format there
+    key = to_entry(url, params, method)
+    if use_cache and cache_backend == 'local':
+        migrate(key, _legacy_key(url, params))
+    return key
+
+def is_cached(url, params=None, method='GET'):
+    return _fresh_entry(_request_key(url, params, method)) is not None
+
+def get_from_cache(url, params, method='GET'):
+    key = _request_key(url, params, method)
+    e = _fresh_entry(key)
+    if e:
+        try:
+            return _read_entry(key, e)
+        except IOError:
+            pass
+
+def cache(url, params, content, method='GET', ttl=None):
+    _cache_entry(to_entry(url, params, method), content, ttl=ttl)
+
+def _cache_entry(key, content, ttl=None, etag='', modified=''):
+    # returns the new entry, which is not kept anywhere if the store failed
+    digest = hashlib.sha1(content).hexdigest()
+    codec = cache_compression if cache_compression in CODECS else ''
+    data = CODECS[codec][0](content) if codec else content
+    ttl = _ttl_seconds(ttl)
+    store = get_store()
+    try:
+        e = store.put(key, data, ttl, etag or '', modified or '', digest, codec)
+        _evict(store)
+    except StoreError:
+        instrument.count('cache.%s.errors' % store.name)
+        return Entry('', time.time(), ttl, len(data), etag or '', modified or '', digest, codec, -1)
+    instrument.count('cache.%s.stores' % store.name)
+    instrument.count('cache.%s.bytes_written' % store.name, len(data))
+    return e
+
+_last_sweep = 0
+
+def _evict(store):
+    # down to the low water mark (so the next few entries don't evict again)
+    # when over cache_max_bytes, and sweeps spent entries every
+    # sweep_interval (the first time, on the first store of a process)
+    global _last_sweep
+    grace = _ttl_seconds(cache_grace)
+    if store.total_bytes() > cache_max_bytes:
+        _last_sweep = time.time()
+        store.evict(int(cache_max_bytes * cache_low_water), grace)
+    elif time.time() - _last_sweep > sweep_interval:
+        _last_sweep = time.time()
+        store.evict(None, grace)
+
+def _renew_entry(key, e, ttl=None):
+    store = get_store()
+    try:
+        return store.renew(key, e, _ttl_seconds(ttl))
+    except StoreError:
+        instrument.count('cache.%s.errors' % store.name)
+        return e
+
+def _read_entry(key, e):
+    # raises IOError if the data is gone, corrupt (or the store failed)
+    store = get_store()
+    try:
+        data = store.read(key, e)
+    except StoreError:
+        instrument.count('cache.%s.errors' % store.name)
+        raise
+    instrument.count('cache.%s.bytes_read' % store.name, len(data))
+    if not e.codec:
+        return data
+    try:
+        return CODECS[e.codec][1](data)
+    except Exception:
+        # truncated or corrupt (zlib.error, a zstd error, or a codec this
+        # python lacks): dropped, so it is downloaded again in full
+        instrument.count('cache.%s.corrupt' % store.name)
+        try:
+            store.drop(key, e)
+        except StoreError:
+            instrument.count('cache.%s.errors' % store.name)
+        raise IOError('corrupt cache entry: %s' % key)
 
 def cached_pct(urls):
     return sum(1. for u in urls if is_cached(u))/len(urls)
 
+#######################################################################
+# retries, rate limiting and circuit breaking
+
+timeout = (5, 30)         # connect, read (seconds)
+max_retries = 4
+backoff_base = 0.5        # seconds; doubled on each retry, with full jitter
+backoff_max = 30
+rate_limit = 10.          # requests per second, per host
+rate_burst = 10
+breaker_threshold = 5     # consecutive failures that open a host's circuit
+breaker_cooldown = 60     # seconds before an open circuit lets a trial request through
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = Lock()
+
+    def take(self):
+        # blocks until a token is available
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class CircuitBreaker(object):
+    # opens after `threshold` consecutive failures and then rejects requests;
+    # after `cooldown` a single trial request is let through, and closes the
+    # circuit again if it succeeds
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if not self.trial and time.time() - self.opened >= self.cooldown:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened = time.time()
+                self.trial = False
+
+_hosts_lock = Lock()
+_buckets = {}
+_breakers = {}
+
+def _host_state(host):
+    with _hosts_lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(rate_limit, rate_burst)
+            _breakers[host] = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        return _buckets[host], _breakers[host]
+
+def _backoff(attempt, retry_after=None):
+    if retry_after is not None:
+        return min(backoff_max, retry_after)
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After', '')
+    return float(value) if value.isdigit() else None
+
 #######################################################################
 
 def _is_valid_url(url):
     parse = urlparse.urlparse(url)
     return parse.scheme and parse.netloc
 
-def fetch(url, post=False, processor=None, **kwargs):
+# the result of fetch_entry: content, its sha1, and the seconds spent on
+# requests for it, without rate limit waits and backoffs (0 for cache hits)
+Fetched = namedtuple('Fetched', 'content digest network')
+
+def fetch(url, post=False, processor=None, ttl=None, **kwargs):
+    fetched = fetch_entry(url, post, processor, ttl, **kwargs)
+    if fetched:
+        return fetched.content
+
+def fetch_entry(url, post=False, processor=None, ttl=None, **kwargs):
+    # returns None if the request failed after all retries, the host's
+    # circuit is open, or the response was not the page (say, a 404)
     params = kwargs.get('data') if post else kwargs.get('params')
-    cached = get_from_cache(url, params)
+    method = 'POST' if post else 'GET'
+    key = _request_key(url, params, method)
+    e, cached = _lookup(key)
     if cached:
+        instrument.count('cache.%s.hit' % cache_backend)
         return cached
+    instrument.count('cache.%s.miss' % cache_backend)
     if not _is_valid_url(url):
         return
+    # concurrent calls for the same key share one request
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[key] = _Flight()
+    if not leader:
+        instrument.count('fetch.coalesced')
+        # short timeouts keep the wait interruptible by ctrl-c
+        while not flight.done.wait(0.5):
+            pass
+        return flight.result
     try:
-        while True:
-            if post:
-                response = session.post(url, **kwargs)
-            else:
-                response = session.get(url, **kwargs)
-            content = processor(response.content) if processor else response.content
-            cache(url, params, content)
-            return content
-    except requests.exceptions.ConnectionError:
-        time.sleep(1)
-    except requests.exceptions.TooManyRedirects:
-        return
+        # the previous leader may have just cached it
+        e, flight.result = _lookup(key)
+        if not flight.result:
+            flight.result = _download(key, e, url, post, processor, ttl, kwargs)
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        flight.done.set()
+    return flight.result
 
+def _lookup(key):
+    # returns the entry, and a Fetched if it is fresh
+    e = _stored_entry(key) if use_cache else None
+    if e and _is_fresh(e):
+        try:
+            return e, Fetched(_read_entry(key, e), e.digest, 0.)
+        except IOError:
+            # evicted by another process meanwhile, or the store failed
+            return None, None
+    return e, None
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+
+_inflight = {} # key -> _Flight of the request being made for it
+_inflight_lock = Lock()
+
+def _download(key, e, url, post, processor, ttl, kwargs):
+    # an expired entry is revalidated rather than downloaded again
+    from requests import exceptions
+    headers = dict(kwargs.pop('headers', None) or {})
+    if e and e.etag:
+        headers['If-None-Match'] = e.etag
+    if e and e.modified:
+        headers['If-Modified-Since'] = e.modified
+    kwargs.setdefault('timeout', timeout)
+    bucket, breaker = _host_state(urlparse.urlparse(url).netloc)
+    retry_after = None
+    network = 0.
+    for attempt in xrange(max_retries + 1):
+        if attempt:
+            instrument.count('fetch.retries')
+            time.sleep(_backoff(attempt, retry_after))
+        if not breaker.allow():
+            return
+        bucket.take()
+        instrument.count('fetch.requests')
+        # every attempt reports to the breaker, including one that gives up
+        # (too many redirects) or raises, or a trial could leave it stuck
+        ok = False
+        start = time.time()
+        try:
+            with instrument.timer('fetch.network'):
+                if post:
+                    response = get_session().post(url, headers=headers, **kwargs)
+                else:
+                    response = get_session().get(url, headers=headers, **kwargs)
+            ok = response.status_code not in RETRY_STATUS
+        except (exceptions.TooManyRedirects, exceptions.InvalidURL, exceptions.InvalidSchema, exceptions.MissingSchema):
+            return # another attempt would not do better
+        except exceptions.RequestException:
+            # connection, timeout, a body cut short or undecodable...
+            response = None
+        finally:
+            network += time.time() - start
+            if ok:
+                breaker.success()
+            else:
+                breaker.failure()
+        if response is None:
+            retry_after = None
+            continue
+        if not ok:
+            retry_after = _retry_after(response)
+            continue
+        instrument.count('fetch.bytes', len(response.content))
+        if not (200 <= response.status_code < 300 or e and response.status_code == 304):
+            # not the page (a 404, say), which would parse to no rows
+            instrument.count('fetch.rejected')
+            return
+        if response.status_code == 304:
+            instrument.count('fetch.not_modified')
+            e = _renew_entry(key, e, ttl)
+            try:
+                return Fetched(_read_entry(key, e), e.digest, network)
+            except IOError:
+                # evicted meanwhile: download it whole
+                headers.pop('If-None-Match', None)
+                headers.pop('If-Modified-Since', None)
+                e = None
+                continue
+        content = processor(response.content) if processor else response.content
+        if not use_cache:
+            return Fetched(content, hashlib.sha1(content).hexdigest(), network)
+        new = _cache_entry(key, content, ttl, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return Fetched(content, new.digest, network)
@@ -0,0 +1,104 @@
+import json
+import sys
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+# per-stage timers and counters for the crawl and query paths. timers keep
+# a call count, total and max seconds; counters are plain sums (cache hits,
+# bytes transferred, ...). both are cheap enough to leave on; `enabled`
+# turns recording off entirely.
+#
+# stages run in a worker process (Crawler's parse_processes) are not seen
+# here, only their time waiting in the parent.
+
+enabled = True
+
+_lock = Lock()
+_timers = {}   # name -> [calls, total seconds, max seconds]
+_counters = {} # name -> sum
+
+def count(name, n=1):
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+def record(name, seconds):
+    if enabled:
+        with _lock:
+            t = _timers.setdefault(name, [0, 0., 0.])
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+
+@contextmanager
+def timer(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
+
+def timed(name):
+    # decorator version of timer
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record(name, time.time() - start)
+        return wrapper
+    return decorator
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+def snapshot():
+    with _lock:
+        return dict(
+            timers = dict((name, dict(calls=c, total=t, max=m)) for name, (c, t, m) in _timers.iteritems()),
+            counters = dict(_counters),
+        )
+
+def summary():
+    # a text table of the timers, then the counters
+    stats = snapshot()
+    lines = ['%-24s %8s %10s %10s %10s' % ('stage', 'calls', 'total s', 'mean ms', 'max ms')]
+    for name, t in sorted(stats['timers'].iteritems()):
+        lines.append('%-24s %8d %10.3f %10.2f %10.2f' % (name, t['calls'], t['total'], t['total'] * 1000 / t['calls'], t['max'] * 1000))
+    if stats['counters']:
+        lines.append('')
+        lines.append('%-24s %8s' % ('counter', 'value'))
+        for name, value in sorted(stats['counters'].iteritems()):
+            lines.append('%-24s %8d' % (name, value))
+    return '\n'.join(lines)
+
+def dump_json(path):
+    with open(path, 'w') as f:
+        json.dump(snapshot(), f, indent=2, sort_keys=True)
+
+@contextmanager
+def profiling(show=True, json_path=None, cprofile_path=None):
+    # wraps a run: prints the summary to stderr at the end if show, and
+    # writes the stats as json and/or a cProfile dump (for pstats/snakeviz)
+    profiler = None
+    if cprofile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+        if show:
+            print >> sys.stderr, summary()
+        if json_path:
+            dump_json(json_path)
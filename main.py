@@ -1,18 +1,20 @@
 # -*- coding: utf-8 -*-
+import argparse
+import json
 import os
-import cPickle as pkl
-import re
-import readline
-import requests
+import subprocess
 import sys
-import time
 
-from bs4 import BeautifulSoup as bsoup
-from collections import OrderedDict
-from threading import Thread, RLock
-from Queue import Queue, Empty
+from datetime import timedelta
 
-from fetch import fetch
+import instrument
+import occupancy
+from occupancy import DAY_END, DAY_START, DAYS, SEMESTERS, minutes, nice_minutes
+from ui import nice_hour, print_and_select_from_list, sorted_heb, yesno
+
+# queries only need the occupancy snapshot, so the crawling side (pipeline,
+# sources, fetch, and through them requests, bs4 and multiprocessing) is
+# imported by the functions that crawl, the first time one runs
 
 ###################################################################################
 # constants
@@ -26,164 +28,40 @@ HOURS = {
     (18,19): 6,
 }
 
-DAYS = {
-    u'א': 1,
-    u'ב': 2,
-    u'ג': 3,
-    u'ד': 4,
-    u'ה': 5,
-    u'ו': 6,
-}
-
-SEMESTERS = {
-    u'א': 1,
-    u'ב': 2,
-    u'קיץ': 3,
-}
-
-###################################################################################
-# requests
-
-def gen_request_data(semester, day, hour):
-    data = OrderedDict([
-        ('MfcISAPICommand', 'but'),
-        ('year',''),
-        ('semester',semester),
-        ('hour',hour),
-        ('yom',day),
-        ('department1','08'), # all art
-        ('department2','05'), # all engineering
-        ('department3','10'), # all social
-        ('department4','04'), # all life
-        ('department5','06'), # all humanities
-        ('department6','03'), # all exact
-        ('department7','14'), # all law
-        ('course_nam',''),
-        ('teach_nam',''),
-        ('department8','12'), # all management
-        ('department9','01'), # all medicine
-        ('department10','11'), # social work (others needed)
-        ('department11','21712172'), # english + foreign languages
-        ('department12','188018821883'), # all whatever this is
-        ('department13','1843'), # all cyber
-    ])
-    if not semester:
-        data.pop('semester')
-    if not day:
-        data.pop('yom')
-    if not hour:
-        data.pop('hour')
-    yield data
-    # clear deps 
-    for key in data.keys():
-        if key.startswith('department'):
-            data[key] = ''
-    additional_dep10 = ['11', '07', '09', '15']
-    for dep10 in additional_dep10:
-        data['department10'] = dep10
-        yield data
-
-def make_request(data, func):
-    return fetch('http://yedion.tau.ac.il/yed/yednew.dll', data=data, post=True, processor=func)
-
-def get_data(semester, day, hour):
-    all_data = []
-    for data in gen_request_data(semester=semester, day=day, hour=hour):
-        content = make_request(data, minify)
-        all_data.extend(parse(content))
-    return process(all_data)
-
-def process(data):
-    # all rooms: building -> room
-    all_rooms = {}
-    for d in data:
-        all_rooms.setdefault(d['building'], set()).add(d['room'])
-    return all_rooms
-
-all_hours = range(7,21)
-
-def normalize_hours(hours):
-    # e.g. 1630,1800 -> 16,17; 1600,1830 -> 16,17,18
-    hours = sorted(hours)
-    h1 = int(hours[0][:2])
-    h2 = int(hours[1][:2])
-    if hours[1][2:] == '00':
-        h2 -= 1
-    return range(h1, h2+1)
-
-###################################################################################
-# parsing
-
-def parse(response):
-    data = []
-    soup = bsoup(response) 
-    for tr in soup.findAll('tr'):
-        tds = tr.findAll('td')
-        hours = hours_from_schedule_row(tds)
-        if hours:
-            parsed = parse_schedule_row(tds, hours)
-            if parsed:
-                data.append(parsed)
-    return data
-
-def hours_from_schedule_row(td_list):
-    for td in td_list:
-        match = re.search('\d{4} *- *\d{4}', td.text)
-        if match:
-            hours = [h.strip() for h in match.group().split('-')]
-            if all('0700' < h < '2100' for h in hours):
-                return hours
-
-def parse_schedule_row(td_list, hours):
-    if len(td_list) > 4:
-        building = get_heb(td_list[4].text)
-        room = td_list[3].text.strip()
-        day = get_heb(td_list[2].text)
-        semester = get_heb(td_list[0].text)
-        if building and room:
-            return dict(
-                building = building,
-                room = room,
-                day = day,
-                hours = hours,
-                semester = semester,
-            )
-
-def minify(response):
-    response = response.replace('<A ', '<a ').replace('</A>', '</a>').replace('&nbsp;','').replace('\n','')
-    response = re.sub('<a [\s\S]*?</a>', '', response)
-    response = re.sub('<img [\s\S]*?>', '', response)
-    response = re.sub('<th [\s\S]*?</th>', '', response)
-    response = re.sub('colspan=".*?"', '', response)
-    response = re.sub('class=".*?"', '', response)
-    response = re.sub('bgcolor=".*?"', '', response)
-    response = response.replace('align="right"','').replace('dir="rtl"','').replace('align ="right"','')
-    response = response.replace('  ',' ')
-    return response
-
 ###################################################################################
 # interaction
 
-def get_heb(s):
-    return s.strip() # not reversing - [::-1]
-
-def sorted_heb(slist):
-    return sorted(slist)
-
-def nice_hour(h):
-    return '%02d:00' % h
-
-def get_all_rooms():
-    cache_path = '.allrooms'
-    if os.path.exists(cache_path):
-        return pkl.load(open(cache_path, 'rb'))
-    print 'loading rooms for the first time...'
-    rooms = get_data('', '', '')
-    pkl.dump(rooms, open(cache_path, 'wb'))
-    return rooms
-
-def interact():
-    all_rooms = get_all_rooms()
+OCCUPANCY_PATH = '.occupancy'
+OCCUPANCY_MAX_AGE = timedelta(days=1)
+OCCUPANCY_SOURCE = 'yednew' # a sources.SOURCES name, or 'auto'
+SOURCE_NAMES = ['yednew', 'syllabus'] # sources.SOURCES, without importing it
+CACHE_NAMES = ['local', 'sqlite', 'redis'] # fetch.STORES, likewise
+
+def get_occupancy(refresh=False, source=None, on_partial=None, fallback=True):
+    # built from a full crawl of a source and kept as a snapshot file, which
+    # is mapped on startup until it gets too old. a crawl hands the index so
+    # far to on_partial(index, done, total) as it goes (see pipeline.stream).
+    # a crawl with failed pages is not saved: the previous snapshot is kept,
+    # and with fallback returned however old it is (else IncompleteCrawl).
+    with instrument.timer('snapshot.load'):
+        index = None if refresh else occupancy.load(OCCUPANCY_PATH, max_age=OCCUPANCY_MAX_AGE)
+    if index is None:
+        import pipeline
+        source = pipeline.get_source(source or OCCUPANCY_SOURCE)
+        print >> sys.stderr, 'loading rooms from %s...' % source.name
+        try:
+            with instrument.timer('crawl'):
+                index = pipeline.stream(source, on_partial=on_partial)
+        except pipeline.IncompleteCrawl as e:
+            index = occupancy.load(OCCUPANCY_PATH) if fallback else None
+            if index is None:
+                raise
+            print >> sys.stderr, '%s, using the previous snapshot' % e
+            return index
+        occupancy.save(index, OCCUPANCY_PATH)
+    return index
+
+def interact(index):
     while True:
         semester = print_and_select_from_list('select semester', sorted_heb(SEMESTERS.keys()))
         if semester:
@@ -192,20 +70,7 @@ def interact():
                 hours_list = sorted([h for h_list in HOURS for h in h_list])
                 hour = print_and_select_from_list('select hour', hours_list, printer=nice_hour)
                 if hour:
-                    print 'fetching data...'
-                    occupied_rooms = get_data(
-                        semester = SEMESTERS[semester],
-                        day = DAYS[day],
-                        hour = [v for k, v in HOURS.iteritems() if hour in k][0],
-                    )
-                    free_rooms = {} # building -> rooms
-                    for building, rooms in all_rooms.iteritems():
-                        if building in occupied_rooms:
-                            for room in rooms:
-                                if room not in occupied_rooms[building]:
-                                    free_rooms.setdefault(building, []).append(room)
-                        else:
-                            free_rooms[building] = rooms.copy()
+                    free_rooms = index.free_rooms(SEMESTERS[semester], DAYS[day], hour)
                     final_interact(semester, day, hour, free_rooms)
                     if not yesno('continue?'):
                         break
@@ -228,64 +93,311 @@ def final_interact(semester, day, hour, free_rooms):
             return
 
 ###################################################################################
-# utils
-
-QUIT_STRING = '\\q'
-
-def print_and_select_from_list(msg, lst, printer=None):
-    print_list(lst, printer)
-    return select_from_list(msg, lst, printer)
-
-def print_list(lst, printer=None):
-    i = 1
-    for item in lst:
-        item_str = printer(item) if printer else item
-        print_item(i, item_str)
-        i += 1
-
-def print_item(i, item):
-    print '%s. %s' % (i, item)
-
-def select_from_list(msg, lst, printer=None):
-    while True:
+# command line
+
+def axis_value(value, names):
+    # a semester/day given either by number or by its hebrew name
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    if value in names:
+        return names[value]
+    value = int(value)
+    if value not in names.values():
+        raise ValueError('out of range: %s' % value)
+    return value
+
+def query_range(query, required=True):
+    # the query's from/to times (e.g. '14:15', 1415 or 14) as minutes
+    if not required and query.get('from') is None and query.get('to') is None:
+        return DAY_START, DAY_END
+    start = minutes(str(query['from'])) if query.get('from') is not None else DAY_START
+    end = minutes(str(query['to'])) if query.get('to') is not None else DAY_END
+    if start >= end:
+        raise ValueError('empty time range')
+    return start, end
+
+def query_buildings(query):
+    return query.get('buildings') or ([query['building']] if query.get('building') else None)
+
+@instrument.timed('query')
+def query_free(index, query):
+    # query: dict with semester, day, either hour or hours (whole hour slots)
+    # or from and/or to (exact times), and optionally building or buildings.
+    # returns building -> free rooms.
+    semester = axis_value(query['semester'], SEMESTERS)
+    day = axis_value(query['day'], DAYS)
+    buildings = query_buildings(query)
+    hours = query.get('hours', query.get('hour'))
+    if hours is None:
+        if query.get('from') is None and query.get('to') is None:
+            raise KeyError('hour')
+        start, end = query_range(query)
+        return index.free_between(semester, day, start, end, buildings=buildings)
+    hours = [int(h) for h in hours] if isinstance(hours, list) else int(hours)
+    return index.free_rooms(semester, day, hours, buildings=buildings)
+
+@instrument.timed('query')
+def query_window(index, query):
+    # query: dict with semester, day, and optionally from, to, building(s)
+    # and limit. returns the longest free window of each room, longest first.
+    start, end = query_range(query, required=False)
+    windows = index.longest_free(
+        axis_value(query['semester'], SEMESTERS),
+        axis_value(query['day'], DAYS),
+        start,
+        end,
+        buildings = query_buildings(query),
+        limit = int(query['limit']) if query.get('limit') else None,
+    )
+    return [
+        dict(building=building, room=room, minutes=length, start=nice_minutes(s), end=nice_minutes(e))
+        for length, s, e, building, room in windows
+    ]
+
+@instrument.timed('query')
+def query_week(index, query):
+    # query: dict with semester, and optionally building(s). the whole week
+    # from one pass over the index: building -> room -> day (1-6) -> the
+    # hours (7-20) the room is free.
+    ids, occupied = index.week(axis_value(query['semester'], SEMESTERS), buildings=query_buildings(query))
+    if not isinstance(occupied, list):
+        occupied = occupied.tolist()
+    week = {}
+    for room_id, days in zip(ids, occupied):
+        building, room = index.room(room_id)
+        week.setdefault(building, {})[room] = dict(
+            (day, [h for h, taken in zip(occupancy.HOURS, hours) if not taken])
+            for day, hours in enumerate(days, 1)
+        )
+    return week
+
+@instrument.timed('query')
+def query_runs(index, query):
+    # query: dict with semester, min_hours, and optionally day and
+    # building(s). every stretch of at least min_hours free hours in the
+    # week (or on the day), by building, room, day and time.
+    min_hours = int(query['min_hours'])
+    if min_hours < 1:
+        raise ValueError('min_hours must be at least 1')
+    day = axis_value(query['day'], DAYS) if query.get('day') is not None else None
+    runs = index.free_runs(axis_value(query['semester'], SEMESTERS), min_hours, buildings=query_buildings(query))
+    return [
+        dict(building=building, room=room, day=d, hours=length, start=nice_hour(h), end=nice_hour(h + length))
+        for building, room, d, h, length in runs
+        if day is None or d == day
+    ]
+
+def run_free(index, args):
+    query = dict(semester=args.semester, day=args.day, hours=args.hour, buildings=[b.decode('utf-8') for b in args.building])
+    if args.hour is None:
+        query.update({'from': args.start, 'to': args.end})
+    free_rooms = query_free(index, query)
+    if args.json:
+        print json.dumps(free_rooms, sort_keys=True)
+        return
+    for building in sorted_heb(free_rooms.keys()):
+        print ('%s: %s' % (building, ','.join(free_rooms[building]))).encode('utf-8')
+
+def run_window(index, args):
+    query = {'semester': args.semester, 'day': args.day, 'from': args.start, 'to': args.end,
+             'buildings': [b.decode('utf-8') for b in args.building], 'limit': args.limit}
+    windows = query_window(index, query)
+    if args.json:
+        print json.dumps(windows, sort_keys=True)
+        return
+    for w in windows:
+        print ('%(building)s %(room)s: %(start)s-%(end)s (%(minutes)d min)' % w).encode('utf-8')
+
+def run_week(index, args):
+    query = dict(semester=args.semester, day=args.day, min_hours=args.min_hours, buildings=[b.decode('utf-8') for b in args.building])
+    if args.min_hours:
+        runs = query_runs(index, query)
+        if args.json:
+            print json.dumps(runs, sort_keys=True)
+            return
+        for r in runs:
+            print ('%(building)s %(room)s: day %(day)d %(start)s-%(end)s (%(hours)d h)' % r).encode('utf-8')
+        return
+    week = query_week(index, query)
+    if args.json:
+        print json.dumps(week, sort_keys=True)
+        return
+    # a row per room, a column per day, '.' for a free hour and '#' for a taken one
+    for building in sorted_heb(week.keys()):
+        for room in sorted(week[building]):
+            days = week[building][room]
+            grid = ' '.join(''.join('.' if h in days[d] else '#' for h in occupancy.HOURS) for d in sorted(days))
+            print ('%s %s: %s' % (building, room, grid)).encode('utf-8')
+
+def run_batch(index, lines, out):
+    # one json query per line in, one json result per line out. queries with
+    # "window": true get the longest free windows instead of free rooms, and
+    # "week": true the whole week (or with min_hours, the free stretches).
+    for line in lines:
+        if not line.strip():
+            continue
         try:
-            inp = read_input(msg + ' (1-' + str(len(lst)) + ')')
-            if not inp:
-                return
-            choice = int(inp) - 1
-            if choice < 0:
-                raise IndexError
-            selection = lst[choice]
-            print '---'
-            print 'selected:', printer(selection) if printer else selection
-            print '---'
-            return selection
-        except ValueError:
-            print 'invalid input'
-        except IndexError:
-            print 'out of range'
-
-def read_input(msg):
-    inp = raw_input("%s: " % msg)
-    if not inp:
-        print 'cancelled.'
-    elif inp == QUIT_STRING:
-        sys.exit(0)
-    return inp
-
-def yesno(msg):
-    inp = None
-    y = ['y', 'yes', 'yy', 'yyy', 'ye', 'yea', 'yeah', '']
-    n = ['n', 'no', 'nn', 'nnn','nah', 'nope', 'sorry']
-    while inp not in y + n:
-        inp = raw_input(msg + ' ([y]/n) ').lower()
-        if inp == QUIT_STRING:
-            sys.exit(0)
-    return inp in y
+            query = json.loads(line)
+            if not isinstance(query, dict):
+                raise ValueError('a query is a json object')
+            if query.get('window'):
+                result = dict(query=query, windows=query_window(index, query))
+            elif query.get('week') and query.get('min_hours') is not None:
+                result = dict(query=query, runs=query_runs(index, query))
+            elif query.get('week'):
+                result = dict(query=query, week=query_week(index, query))
+            else:
+                result = dict(query=query, free=query_free(index, query))
+        except (ValueError, KeyError, TypeError) as e:
+            result = dict(query=line.strip(), error=str(e))
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+        out.flush()
+
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError('want a positive number: %s' % value)
+    return n
+
+def shard_arg(value):
+    # 'i/N' -> (i, N)
+    index, count = [int(n) for n in value.split('/')]
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('want i/N with 0 <= i < N: %s' % value)
+    return index, count
+
+def shard_path(path, index, count):
+    return '%s.shard-%d-of-%d' % (path, index, count)
+
+def run_crawl(args):
+    # a full crawl into a snapshot, or one shard of it into a partial
+    # snapshot (see merge). with --processes, all the shards run as local
+    # processes and are merged.
+    import pipeline
+    source = pipeline.get_source(args.source)
+    if args.processes:
+        return crawl_local_shards(source.name, args.processes, args.out or OCCUPANCY_PATH, cache_argv(args))
+    out = args.out or (shard_path(OCCUPANCY_PATH, *args.shard) if args.shard else OCCUPANCY_PATH)
+    try:
+        index = pipeline.run(source, shard_of=args.shard)
+    except pipeline.IncompleteCrawl as e:
+        raise SystemExit('%s, %s not written' % (e, out))
+    occupancy.save(index, out)
+    print >> sys.stderr, '%d rooms from %s -> %s' % (len(index), source.name, out)
+
+def cache_argv(args):
+    # the cache options, for the processes run_crawl starts
+    return (['--cache', args.cache] if args.cache else []) + (['--cache-url', args.cache_url] if args.cache_url else [])
+
+def crawl_local_shards(source, count, out, cache_args=()):
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    paths = [shard_path(out, i, count) for i in xrange(count)]
+    procs = [
+        subprocess.Popen([sys.executable, script, '--source', source] + list(cache_args) + ['crawl', '--shard', '%d/%d' % (i, count), '--out', path])
+        for i, path in enumerate(paths)
+    ]
+    try:
+        if any([p.wait() for p in procs]):
+            raise SystemExit('a shard crawl failed')
+        run_merge(paths, out)
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+def run_merge(paths, out):
+    import pipeline
+    index = pipeline.merge_shards(paths)
+    occupancy.save(index, out)
+    print >> sys.stderr, '%d rooms from %d shards -> %s' % (len(index), len(paths), out)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='find free rooms; runs interactively without a command')
+    parser.add_argument('--refresh', action='store_true', help='rebuild the occupancy index first')
+    parser.add_argument('--source', default=OCCUPANCY_SOURCE, choices=SOURCE_NAMES + ['auto'],
+                        help='where a rebuild crawls from; auto picks the one with the least left to download')
+    parser.add_argument('--cache', choices=CACHE_NAMES, help='where fetched pages are cached (default local, the .cache directory)')
+    parser.add_argument('--cache-url', help='the sqlite file or redis://host:port/db url of the cache')
+    parser.add_argument('--profile', action='store_true', help='print per-stage timings and counters to stderr at exit')
+    parser.add_argument('--profile-json', metavar='PATH', help='also write them as json')
+    parser.add_argument('--cprofile', metavar='PATH', help='also write a cProfile dump')
+    commands = parser.add_subparsers(dest='command')
+    free = commands.add_parser('free', help='free rooms at the given hours, or between two times')
+    free.add_argument('--semester', required=True, help='1-3 or hebrew name')
+    free.add_argument('--day', required=True, help='1-6 or hebrew name')
+    free.add_argument('--hour', type=int, action='append', choices=occupancy.HOURS, metavar='HOUR', help='7-20, repeat for a range')
+    free.add_argument('--from', dest='start', help='e.g. 14:15, instead of --hour')
+    free.add_argument('--to', dest='end', help='e.g. 15:45, instead of --hour')
+    free.add_argument('--building', default=[], action='append', help='repeat for several buildings')
+    free.add_argument('--json', action='store_true')
+    window = commands.add_parser('window', help='longest free window of each room, longest first')
+    window.add_argument('--semester', required=True, help='1-3 or hebrew name')
+    window.add_argument('--day', required=True, help='1-6 or hebrew name')
+    window.add_argument('--from', dest='start', help='start of the day to look at, e.g. 12:00')
+    window.add_argument('--to', dest='end', help='end of the day to look at, e.g. 18:00')
+    window.add_argument('--building', default=[], action='append', help='repeat for several buildings')
+    window.add_argument('--limit', default=20, type=int, help='rooms to list, 0 for all')
+    window.add_argument('--json', action='store_true')
+    week = commands.add_parser('week', help='the free hours of every room over the whole week')
+    week.add_argument('--semester', required=True, help='1-3 or hebrew name')
+    week.add_argument('--min-hours', type=int, help='list the stretches of at least this many free hours instead')
+    week.add_argument('--day', help='with --min-hours, only this day (1-6 or hebrew name)')
+    week.add_argument('--building', default=[], action='append', help='repeat for several buildings')
+    week.add_argument('--json', action='store_true')
+    commands.add_parser('batch', help='json queries from stdin, e.g. {"semester": 1, "day": 2, "hour": 10}')
+    commands.add_parser('interact', help='menu driven (the default)')
+    crawl = commands.add_parser('crawl', help='rebuild the snapshot, or a shard of it, without querying')
+    crawl.add_argument('--shard', type=shard_arg, help='i/N: crawl only shard i (0 <= i < N) of the source')
+    crawl.add_argument('--processes', type=positive_int, help='crawl all of N shards in local processes, then merge them')
+    crawl.add_argument('--out', help='snapshot to write (default %s, or %s.shard-i-of-N)' % (OCCUPANCY_PATH, OCCUPANCY_PATH))
+    merge = commands.add_parser('merge', help='merge shard snapshots into one')
+    merge.add_argument('shards', nargs='+')
+    merge.add_argument('--out', default=OCCUPANCY_PATH)
+    serve = commands.add_parser('serve', help='http query service, see server.py')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', default=8080, type=int)
+    serve.add_argument('--refresh-interval', default=3600, type=int, help='seconds between index rebuilds')
+    serve.add_argument('--verbose', action='store_true', help='log every request')
+    if not set(argv) & set(commands.choices):
+        argv = argv + ['interact']
+    args = parser.parse_args(argv)
+    if args.command == 'free' and args.hour is None and args.start is None and args.end is None:
+        free.error('one of --hour or --from/--to is required')
+    return args
+
+def main(argv):
+    args = parse_args(argv)
+    if not (args.profile or args.profile_json or args.cprofile):
+        return run(args)
+    with instrument.profiling(args.profile, args.profile_json, args.cprofile):
+        return run(args)
+
+def run(args):
+    if args.cache or args.cache_url:
+        import fetch
+        fetch.set_store(args.cache or fetch.cache_backend, args.cache_url)
+    if args.command == 'crawl':
+        return run_crawl(args)
+    if args.command == 'merge':
+        return run_merge(args.shards, args.out)
+    if args.command == 'serve':
+        import server
+        return server.serve(args.host, args.port, args.refresh_interval, args.verbose, refresh=args.refresh, source=args.source)
+    index = get_occupancy(refresh=args.refresh, source=args.source)
+    if args.command == 'interact':
+        return interact(index)
+    if args.command == 'free':
+        run_free(index, args)
+    elif args.command == 'window':
+        run_window(index, args)
+    elif args.command == 'week':
+        run_week(index, args)
+    elif args.command == 'batch':
+        run_batch(index, iter(sys.stdin.readline, ''), sys.stdout)
 
 if __name__ == '__main__':
     try:
-        interact()
+        main(sys.argv[1:])
     except KeyboardInterrupt:
         print
         print 'exiting'
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+import bisect
+import mmap
+import operator
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+from array import array
+
+# numpy is optional. the bulk paths import it on first use (see
+# import_numpy), and once it is in, queries and snapshot loads use it too; a
+# one-shot query from a snapshot is faster without paying for the import.
+np = None
+_numpy_tried = False
+
+def import_numpy():
+    global np, _numpy_tried
+    if not _numpy_tried:
+        _numpy_tried = True
+        try:
+            import numpy as np
+        except ImportError:
+            pass
+    return np
+
+# room occupancy index: a rooms x semesters x days x hours byte matrix,
+# with 1 where the room is taken. building and room names are interned into
+# a string table, so a room is just a pair of string ids. "free rooms at X"
+# is a strided slice of the matrix (or a numpy column lookup), without any
+# fetching.
+#
+# next to the matrix, each room keeps its meetings per semester and day as
+# sorted, merged (start, end) minute ranges, for exact queries like "free
+# between 14:15 and 15:45" or "longest free window", which whole hour slots
+# get wrong both ways (a 16:30-18:00 meeting takes the 16 and 17 slots).
+
+# slot axes, keyed by their names in the schedule pages
+SEMESTERS = {
+    u'א': 1,
+    u'ב': 2,
+    u'קיץ': 3,
+}
+
+DAYS = {
+    u'א': 1,
+    u'ב': 2,
+    u'ג': 3,
+    u'ד': 4,
+    u'ה': 5,
+    u'ו': 6,
+}
+
+HOURS = range(7, 21)
+
+SLOT_COUNT = len(SEMESTERS) * len(DAYS) * len(HOURS)
+
+def slot(semester, day, hour):
+    return ((semester - 1) * len(DAYS) + (day - 1)) * len(HOURS) + (hour - HOURS[0])
+
+def normalize_hours(hours):
+    # e.g. 1630,1800 -> 16,17; 1600,1830 -> 16,17,18
+    hours = sorted(hours)
+    h1 = int(hours[0][:2])
+    h2 = int(hours[1][:2])
+    if hours[1][2:] == '00':
+        h2 -= 1
+    return range(h1, h2+1)
+
+DAY_START = HOURS[0] * 60
+DAY_END = (HOURS[-1] + 1) * 60
+
+def minutes(t):
+    # '1630', '16:30' or '16' -> 990
+    t = t.replace(':', '')
+    if len(t) <= 2:
+        t += '00'
+    m = int(t[:-2]) * 60 + int(t[-2:])
+    if int(t[-2:]) >= 60 or not 0 <= m <= 24 * 60:
+        raise ValueError('bad time: %s' % t)
+    return m
+
+def nice_minutes(m):
+    return '%02d:%02d' % divmod(m, 60)
+
+def minute_range(hours):
+    # e.g. ('1630', '1800') -> (990, 1080)
+    start, end = sorted(minutes(h) for h in hours)
+    return start, end
+
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+def _hour_list(hours):
+    if isinstance(hours, int):
+        hours = [hours]
+    return [h for h in hours if h in HOURS]
+
+def _query_hours(hours):
+    # unlike a meeting's, which is clipped to the slots, a query's hours
+    # must all be slots: dropping one would report rooms free at it, and
+    # no hours at all, every room free
+    hours = [hours] if isinstance(hours, int) else list(hours)
+    if not hours:
+        raise ValueError('no hours given')
+    for h in hours:
+        if h not in HOURS:
+            raise ValueError('hour out of range (%d-%d): %s' % (HOURS[0], HOURS[-1], h))
+    return hours
+
+# hours as parsed, e.g. ('1630', '1800') -> (the indexes into HOURS of the
+# slots it takes, start minute, end minute). rows repeat a few dozen
+# distinct spans, so each is worked out once.
+_spans = {}
+
+def span_slots(hours):
+    try:
+        return _spans[hours]
+    except KeyError:
+        start, end = minute_range(hours)
+        indexes = tuple(h - HOURS[0] for h in _hour_list(normalize_hours(hours)))
+        span = _spans[tuple(hours)] = (indexes, start, end)
+        return span
+
+class Occupancy(object):
+
+    VERSION = 4
+
+    def __init__(self):
+        self.strings = []        # string id -> string
+        self.string_ids = {}     # string -> string id
+        self.room_keys = []      # room id -> (building string id, room string id)
+        self.room_ids = {}       # (building string id, room string id) -> room id
+        self.matrix = array('B') # room id * SLOT_COUNT + slot -> 1 if occupied
+        self.intervals = {}      # (room id, semester, day) -> sorted, merged (start, end) minutes
+        self.unmerged = set()    # keys of intervals added to since the last merge
+
+    def __len__(self):
+        return len(self.room_keys)
+
+    def intern(self, s):
+        if s not in self.string_ids:
+            self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.string_ids[s]
+
+    def writable_matrix(self):
+        # a loaded snapshot is backed by the mapped file until it changes
+        if not isinstance(self.matrix, array):
+            self.matrix = array('B', self.matrix.tostring())
+        return self.matrix
+
+    def room_id(self, building, room):
+        key = (self.intern(building), self.intern(room))
+        if key not in self.room_ids:
+            self.room_ids[key] = len(self.room_keys)
+            self.room_keys.append(key)
+            self.writable_matrix().extend(array('B', [0]) * SLOT_COUNT)
+        return self.room_ids[key]
+
+    def room(self, room_id):
+        building, room = self.room_keys[room_id]
+        return self.strings[building], self.strings[room]
+
+    def add_interval(self, room_id, semester, day, start, end):
+        key = (room_id, semester, day)
+        self.intervals.setdefault(key, []).append((start, end))
+        self.unmerged.add(key)
+
+    def merged(self):
+        for key in self.unmerged:
+            self.intervals[key] = merge_intervals(self.intervals[key])
+        self.unmerged.clear()
+        return self.intervals
+
+    def add(self, row):
+        # row: (building, room, day, hours, semester) as parsed from a page.
+        # rows with an unknown semester or day only register the room.
+        building, room, day, hours, semester = row
+        room_id = self.room_id(building, room)
+        if semester in SEMESTERS and day in DAYS:
+            indexes, start, end = span_slots(tuple(hours))
+            base = room_id * SLOT_COUNT + slot(SEMESTERS[semester], DAYS[day], HOURS[0])
+            matrix = self.writable_matrix()
+            for i in indexes:
+                matrix[base + i] = 1
+            self.add_interval(room_id, SEMESTERS[semester], DAYS[day], start, end)
+
+    def add_rows(self, rows):
+        if import_numpy() is None:
+            for row in rows:
+                self.add(row)
+            self.merged()
+            return
+        # register rooms first, then set all the occupied cells in one go
+        cells = []
+        for building, room, day, hours, semester in rows:
+            room_id = self.room_id(building, room)
+            if semester in SEMESTERS and day in DAYS:
+                semester, day = SEMESTERS[semester], DAYS[day]
+                indexes, start, end = span_slots(tuple(hours))
+                base = room_id * SLOT_COUNT + slot(semester, day, HOURS[0])
+                cells.extend(base + i for i in indexes)
+                self.add_interval(room_id, semester, day, start, end)
+        self.merged()
+        if cells:
+            m = np.frombuffer(self.writable_matrix(), dtype=np.uint8)
+            m.setflags(write=True)
+            m[np.array(cells)] = 1
+
+    def copy(self):
+        # a separate index with the same rooms and meetings, e.g. to query
+        # while this one is still being added to
+        index = Occupancy()
+        index.strings = list(self.strings)
+        index.string_ids = dict(self.string_ids)
+        index.room_keys = list(self.room_keys)
+        index.room_ids = dict(self.room_ids)
+        index.matrix = array('B', self.matrix.tostring())
+        index.intervals = dict((key, list(ranges)) for key, ranges in self.merged().iteritems())
+        return index
+
+    def merge(self, other):
+        # adds the rooms and meetings of another index, e.g. a crawl shard
+        ids = [self.room_id(*other.room(i)) for i in xrange(len(other))]
+        matrix = self.writable_matrix()
+        other_matrix = array('B', other.matrix.tostring())
+        for other_id, room_id in enumerate(ids):
+            row = other_matrix[other_id * SLOT_COUNT:(other_id + 1) * SLOT_COUNT]
+            base = room_id * SLOT_COUNT
+            if any(matrix[base:base + SLOT_COUNT]):
+                row = array('B', map(operator.or_, matrix[base:base + SLOT_COUNT], row))
+            matrix[base:base + SLOT_COUNT] = row
+        for (other_id, semester, day), ranges in other.merged().iteritems():
+            key = (ids[other_id], semester, day)
+            self.intervals.setdefault(key, []).extend(ranges)
+            self.unmerged.add(key)
+        self.merged()
+
+    def occupied(self, semester, day, hours):
+        # room id -> 1 if the room is taken at any of the hours
+        slots = [slot(semester, day, h) for h in _query_hours(hours)]
+        if np is not None:
+            m = np.frombuffer(self.matrix, dtype=np.uint8).reshape(-1, SLOT_COUNT)
+            return m[:, slots].any(axis=1) if slots else np.zeros(len(self), dtype=bool)
+        columns = [self.matrix[s::SLOT_COUNT].tolist() for s in slots]
+        if not columns:
+            return [0] * len(self)
+        return reduce(lambda a, b: map(operator.or_, a, b), columns)
+
+    def free_rooms(self, semester, day, hours, buildings=None):
+        # building -> sorted rooms that are free at all of the given hours
+        taken = self.occupied(semester, day, hours)
+        if isinstance(taken, list):
+            free_ids = [i for i, t in enumerate(taken) if not t]
+        else:
+            free_ids = np.flatnonzero(~taken)
+        free = {}
+        for room_id in free_ids:
+            building, room = self.room(room_id)
+            if buildings is None or building in buildings:
+                free.setdefault(building, []).append(room)
+        for rooms in free.itervalues():
+            rooms.sort()
+        return free
+
+    def week(self, semester, buildings=None):
+        # (room ids, occupied) for the whole week of a semester in one pass:
+        # occupied[i][d][h] is 1 if room ids[i] is taken on day d + 1 at
+        # HOURS[h]. a rooms x days x hours bool array when numpy is loaded.
+        ids = list(self._room_ids(buildings))
+        first = slot(semester, 1, HOURS[0])
+        width = len(DAYS) * len(HOURS)
+        if np is not None:
+            m = np.frombuffer(self.matrix, dtype=np.uint8).reshape(-1, SLOT_COUNT)
+            week = m[np.array(ids, dtype=int), first:first + width]
+            return ids, week.reshape(-1, len(DAYS), len(HOURS)).astype(bool)
+        occupied = []
+        for room_id in ids:
+            base = room_id * SLOT_COUNT + first
+            occupied.append([
+                self.matrix[base + d * len(HOURS):base + (d + 1) * len(HOURS)].tolist()
+                for d in xrange(len(DAYS))
+            ])
+        return ids, occupied
+
+    def free_runs(self, semester, min_hours=1, buildings=None):
+        # every run of at least min_hours consecutive free hour slots in the
+        # week, as sorted (building, room, day, first hour, hours)
+        ids, occupied = self.week(semester, buildings)
+        if np is not None:
+            # a free run starts where free goes 0 -> 1 and ends at 1 -> 0;
+            # nonzero lists both in (room, day) order, so they pair up
+            free = np.zeros((len(ids), len(DAYS), len(HOURS) + 2), dtype=np.int8)
+            free[:, :, 1:-1] = ~occupied
+            edges = np.diff(free, axis=2)
+            rooms, days, starts = np.nonzero(edges == 1)
+            lengths = np.nonzero(edges == -1)[2] - starts
+            keep = lengths >= min_hours
+            found = zip(rooms[keep].tolist(), days[keep].tolist(), starts[keep].tolist(), lengths[keep].tolist())
+        else:
+            found = []
+            for i, days in enumerate(occupied):
+                for d, hours in enumerate(days):
+                    start = None
+                    for h, taken in enumerate(hours + [1]):
+                        if not taken and start is None:
+                            start = h
+                        elif taken and start is not None:
+                            if h - start >= min_hours:
+                                found.append((i, d, start, h - start))
+                            start = None
+        runs = []
+        for i, d, start, length in found:
+            building, room = self.room(ids[i])
+            runs.append((building, room, d + 1, HOURS[start], length))
+        runs.sort()
+        return runs
+
+    def busy(self, room_id, semester, day, start, end):
+        # whether the room has a meeting overlapping [start, end) minutes
+        intervals = self.intervals.get((room_id, semester, day))
+        if not intervals:
+            return False
+        i = bisect.bisect_left(intervals, (end,))
+        return i > 0 and intervals[i - 1][1] > start
+
+    def _room_ids(self, buildings):
+        if buildings is None:
+            return xrange(len(self))
+        ids = set(self.string_ids[b] for b in buildings if b in self.string_ids)
+        return [i for i, (b, _) in enumerate(self.room_keys) if b in ids]
+
+    def free_between(self, semester, day, start, end, buildings=None):
+        # building -> sorted rooms with no meeting in [start, end) minutes
+        self.merged()
+        free = {}
+        for room_id in self._room_ids(buildings):
+            if not self.busy(room_id, semester, day, start, end):
+                building, room = self.room(room_id)
+                free.setdefault(building, []).append(room)
+        for rooms in free.itervalues():
+            rooms.sort()
+        return free
+
+    def free_windows(self, room_id, semester, day, start=DAY_START, end=DAY_END):
+        # the (start, end) minute gaps between the room's meetings
+        windows = []
+        t = start
+        for s, e in self.intervals.get((room_id, semester, day), ()):
+            if s >= end:
+                break
+            if s > t:
+                windows.append((t, s))
+            t = max(t, e)
+        if t < end:
+            windows.append((t, end))
+        return windows
+
+    def longest_free(self, semester, day, start=DAY_START, end=DAY_END, buildings=None, limit=None):
+        # each room's longest free window within [start, end), longest first,
+        # as (minutes, window start, window end, building, room)
+        self.merged()
+        result = []
+        for room_id in self._room_ids(buildings):
+            windows = self.free_windows(room_id, semester, day, start, end)
+            if windows:
+                s, e = max(windows, key=lambda w: w[1] - w[0])
+                building, room = self.room(room_id)
+                result.append((e - s, s, e, building, room))
+        result.sort(key=lambda r: (-r[0], r[1], r[3], r[4]))
+        return result[:limit] if limit else result
+
+    def all_rooms(self):
+        # building -> set of rooms
+        all_rooms = {}
+        for room_id in xrange(len(self)):
+            building, room = self.room(room_id)
+            all_rooms.setdefault(building, set()).add(room)
+        return all_rooms
+
+#######################################################################
+# snapshot file
+#
+# header (see HEADER), then the string table as utf-8 bytes with an
+# array('I') of end offsets, the room keys as an array('I') of string id
+# pairs, the intervals as an array('i') of (room id, semester, day, start,
+# end) in key order, and the matrix, which starts at a page boundary so it can be used
+# straight from the mmap. the checksum is a crc32 of everything after the
+# header. snapshots are written to a temp file, synced, and renamed into
+# place.
+
+MAGIC = 'GLMN'
+HEADER = struct.Struct('<4sHHIIIIdI') # magic, version, slot count, strings, string bytes, rooms, intervals, created, crc32
+PAGE = mmap.PAGESIZE
+
+def save(index, path):
+    strings = [s.encode('utf-8') for s in index.strings]
+    offsets = array('I')
+    total = 0
+    for s in strings:
+        total += len(s)
+        offsets.append(total)
+    keys = array('I', [i for key in index.room_keys for i in key])
+    intervals = array('i')
+    for key, ranges in sorted(index.merged().iteritems()):
+        for start, end in ranges:
+            intervals.extend(key + (start, end))
+    body = offsets.tostring() + ''.join(strings) + keys.tostring() + intervals.tostring()
+    padding = '\0' * (-(HEADER.size + len(body)) % PAGE)
+    matrix = index.matrix.tostring()
+    crc = zlib.crc32(matrix, zlib.crc32(body + padding)) & 0xffffffff
+    header = HEADER.pack(MAGIC, index.VERSION, SLOT_COUNT, len(strings), total, len(index), len(intervals) // 5, time.time(), crc)
+    # a temp file of its own, so writers running at once (a server refresh
+    # and a cron crawl, say) don't write into each other's
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(body)
+            f.write(padding)
+            f.write(matrix)
+            f.flush()
+            os.fsync(f.fileno()) # on disk before it replaces the old one
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def load(path, max_age=None):
+    # returns None if there is no usable snapshot: missing, written by
+    # another version, corrupt, or older than max_age (a timedelta)
+    if not os.path.exists(path) or os.path.getsize(path) < HEADER.size:
+        return
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, slot_count, string_count, string_bytes, room_count, interval_count, created, crc = HEADER.unpack_from(mm)
+    if magic != MAGIC or version != Occupancy.VERSION or slot_count != SLOT_COUNT:
+        return
+    if max_age is not None and time.time() - created > max_age.total_seconds():
+        return
+    if zlib.crc32(buffer(mm, HEADER.size)) & 0xffffffff != crc:
+        return
+    pos = HEADER.size
+    offsets = array('I', mm[pos:pos + 4 * string_count])
+    pos += 4 * string_count
+    blob = mm[pos:pos + string_bytes]
+    pos += string_bytes
+    keys = array('I', mm[pos:pos + 8 * room_count])
+    pos += 8 * room_count
+    intervals = array('i', mm[pos:pos + 20 * interval_count])
+    pos += 20 * interval_count
+    pos += -pos % PAGE
+    index = Occupancy()
+    start = 0
+    for end in offsets:
+        index.strings.append(blob[start:end].decode('utf-8'))
+        start = end
+    index.room_keys = zip(keys[::2], keys[1::2])
+    index.string_ids = dict((s, i) for i, s in enumerate(index.strings))
+    index.room_ids = dict((key, i) for i, key in enumerate(index.room_keys))
+    it = iter(intervals)
+    for room_id, semester, day, start, end in zip(it, it, it, it, it):
+        index.intervals.setdefault((room_id, semester, day), []).append((start, end))
+    if np is not None:
+        # read-only view of the mapped file, copied only if the index is modified
+        index.matrix = np.frombuffer(mm, dtype=np.uint8, count=room_count * SLOT_COUNT, offset=pos)
+    else:
+        index.matrix = array('B', mm[pos:pos + room_count * SLOT_COUNT])
+    return index
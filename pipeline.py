@@ -0,0 +1,120 @@
+import time
+import urllib
+import zlib
+
+import instrument
+import occupancy
+from crawl import Crawler, cache_key_args
+from fetch import is_cached
+from occupancy import Occupancy
+from sources import SOURCES
+
+# one staged pipeline for every source:
+#
+#   source -> fetch -> extract -> index
+#
+# the source lists the requests and the parser, the crawler fetches and
+# extracts them (sharing the fetch cache and the parse cache), and stream
+# folds each page's rows, as it completes, into an occupancy index that
+# does not care which source they came from.
+#
+# a page that could not be fetched or parsed leaves its rooms out of the
+# index, where they would show up as free, so a crawl with failed pages
+# raises IncompleteCrawl rather than hand out the index.
+
+class IncompleteCrawl(Exception):
+
+    def __init__(self, failed, total):
+        Exception.__init__(self, '%d of %d pages failed' % (failed, total))
+        self.failed = failed
+        self.total = total
+
+def get_source(name):
+    # a source by name, or 'auto' for the cheapest one to crawl right now
+    if name == 'auto':
+        return choose_source()
+    return SOURCES[name]()
+
+def shard(tasks, index, count):
+    # the tasks of shard `index` (0 <= index < count), split by a hash of
+    # the request, so processes or hosts listing the same tasks agree on it
+    return [task for task in tasks if _task_hash(task) % count == index]
+
+def _task_hash(task):
+    url, kwargs = task if isinstance(task, tuple) else (task, {})
+    params = kwargs.get('data') or kwargs.get('params') or {}
+    return zlib.crc32('%s?%s' % (url, urllib.urlencode(sorted(dict(params).items())))) & 0xffffffff
+
+def pending(tasks):
+    # tasks that are not in the fetch cache
+    count = 0
+    for task in tasks:
+        url, kwargs = task if isinstance(task, tuple) else (task, {})
+        if not is_cached(url, *cache_key_args(kwargs)):
+            count += 1
+    return count
+
+def choose_source(names=None):
+    # the source with the fewest pages left to download; on a tie, the one
+    # with fewer pages overall, then the first listed. a source that lists
+    # nothing (say, its index page failed) is skipped. listing the syllabus
+    # tasks fetches the department list (once, it is cached).
+    names = names or list(SOURCES)
+    best = None
+    for i, name in enumerate(names):
+        source = SOURCES[name]()
+        tasks = source.tasks()
+        cost = (pending(tasks), len(tasks), i)
+        if tasks and (best is None or cost < best[0]):
+            best = cost, source
+    return best[1] if best else SOURCES[names[0]]()
+
+PARTIAL_EVERY = 1. # seconds between the partial indexes stream hands out
+
+def stream(source, tasks=None, progress=None, max_workers=None, on_partial=None):
+    # fetch + extract + index, returning the index; raises IncompleteCrawl,
+    # after the whole crawl, if any page failed. only the pages in flight
+    # are held (see crawl.Crawler's max_pending), not every row of the
+    # crawl. a row repeated on another page sets the same slots and merges
+    # into the same interval, so there is nothing to normalize.
+    # on_partial(index, done, total) gets a copy of the index so far every
+    # PARTIAL_EVERY seconds, to query mid-crawl.
+    tasks = source.tasks() if tasks is None else tasks
+    crawler = Crawler(source.parser, max_workers=max_workers, parse_processes=source.parse_processes)
+    index = Occupancy()
+    published = time.time()
+    failed = 0
+    with instrument.timer('crawl.%s' % source.name):
+        for done, (_, parsed) in enumerate(crawler.crawl(tasks), 1):
+            if parsed is None:
+                failed += 1
+            elif parsed:
+                with instrument.timer('process'):
+                    index.add_rows(parsed)
+            if progress:
+                progress(done, len(tasks))
+            if on_partial and done < len(tasks) and time.time() - published >= PARTIAL_EVERY:
+                on_partial(index.copy(), done, len(tasks))
+                published = time.time()
+    if failed:
+        instrument.count('crawl.failed', failed)
+        raise IncompleteCrawl(failed, len(tasks))
+    return index
+
+def run(source, progress=None, shard_of=None, on_partial=None):
+    # returns the occupancy index. with shard_of=(index, count), only that
+    # shard of the source is crawled.
+    tasks = source.tasks()
+    if shard_of:
+        tasks = shard(tasks, *shard_of)
+    return stream(source, tasks, progress=progress, on_partial=on_partial)
+
+def merge_shards(paths):
+    # one index out of the shard snapshots written by sharded runs
+    index = Occupancy()
+    for path in paths:
+        part = occupancy.load(path)
+        if part is None:
+            raise ValueError('not a usable occupancy snapshot: %s' % path)
+        index.merge(part)
+    return index
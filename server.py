@@ -0,0 +1,181 @@
+import json
+import sys
+import time
+import urlparse
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import deque
+from SocketServer import ThreadingMixIn
+from threading import Event, Lock, Thread
+
+import main
+import occupancy
+
+# free room query service: keeps the occupancy index in memory, rebuilds it
+# in the background every refresh_interval seconds, and answers
+#   /free?semester=1&day=2&hour=10[&hour=11][&building=...]
+#   /free?semester=1&day=2&from=14:15&to=15:45[&building=...]
+#   /window?semester=1&day=2[&from=12:00][&to=18:00][&building=...][&limit=10]
+#   /week?semester=1[&building=...]
+#   /week?semester=1&min_hours=3[&day=2][&building=...]
+#   /metrics
+# from memory. while the first crawl runs, queries are answered from the
+# index so far, and say how far along it is ("partial": done/total pages).
+
+class Metrics(object):
+
+    WINDOW = 1000 # latencies kept for percentiles
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = deque(maxlen=self.WINDOW)
+        self.requests = 0
+        self.errors = 0
+        self.refreshes = 0
+        self.last_refresh = None
+
+    def record(self, latency, ok):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            if not ok:
+                self.errors += 1
+
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            summary = dict(
+                requests = self.requests,
+                errors = self.errors,
+                refreshes = self.refreshes,
+                last_refresh = self.last_refresh,
+            )
+        if latencies:
+            pct = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+            summary.update(
+                mean_ms = sum(latencies) * 1000 / len(latencies),
+                p50_ms = pct(.5),
+                p95_ms = pct(.95),
+                p99_ms = pct(.99),
+                max_ms = latencies[-1] * 1000,
+            )
+        return summary
+
+class FreeRoomsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        start = time.time()
+        url = urlparse.urlparse(self.path)
+        args = urlparse.parse_qs(url.query)
+        status, result = 404, dict(error='not found')
+        if url.path == '/free':
+            status, result = self.query('free', main.query_free, args)
+        elif url.path == '/window':
+            status, result = self.query('windows', main.query_window, args)
+        elif url.path == '/week':
+            if 'min_hours' in args:
+                status, result = self.query('runs', main.query_runs, args)
+            else:
+                status, result = self.query('week', main.query_week, args)
+        elif url.path == '/metrics':
+            status, result = 200, self.server.metrics.summary()
+        body = json.dumps(result, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if url.path in ('/free', '/window', '/week'):
+            self.server.metrics.record(time.time() - start, status == 200)
+
+    def query(self, name, run, args):
+        # name: the key of the result in the response
+        if self.server.index is None:
+            return 503, dict(error='index not loaded yet')
+        try:
+            query = dict((key, values[0]) for key, values in args.iteritems())
+            if 'hour' in args:
+                query['hour'] = args['hour']
+            query['buildings'] = [b.decode('utf-8') for b in args.get('building', [])]
+            result = {name: run(self.server.index, query)}
+            partial = self.server.partial
+            if partial:
+                result['partial'] = '%d/%d' % partial
+            return 200, result
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, dict(error=str(e))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class FreeRoomsServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, loader=None, refresh_interval=3600, verbose=False, source=None):
+        # loader(refresh) returns an occupancy index; defaults to
+        # main.get_occupancy, crawling `source` on refreshes. a crawl with
+        # failed pages raises, so the index being served stays; without a
+        # whole index yet, the previous snapshot is better than none.
+        HTTPServer.__init__(self, address, FreeRoomsHandler)
+        self.loader = loader or (lambda refresh: main.get_occupancy(
+            refresh=refresh, source=source, on_partial=self.load_partial,
+            fallback=self.index is None or self.partial is not None,
+        ))
+        self.refresh_interval = refresh_interval
+        self.verbose = verbose
+        self.metrics = Metrics()
+        self.index = None
+        self.partial = None # (done, total) pages while self.index is partial
+        occupancy.import_numpy() # worth it for a long running server
+        self.stopped = Event()
+
+    def load(self, refresh=False):
+        index = self.loader(refresh)
+        self.index = index # swapped in whole, requests see either index
+        self.partial = None
+        with self.metrics.lock:
+            self.metrics.refreshes += 1
+            self.metrics.last_refresh = time.time()
+
+    def load_partial(self, index, done, total):
+        # only until there is a whole index; a refresh keeps serving the last
+        # one meanwhile
+        if self.index is None or self.partial:
+            self.index = index
+            self.partial = (done, total)
+
+    def start_refresher(self, refresh=False):
+        # loads the index first, so requests are served (with a 503 until
+        # the first partial index) while the first crawl runs
+        t = Thread(target=self.refresh_loop, args=(refresh,))
+        t.daemon = True
+        t.start()
+        return t
+
+    def refresh_loop(self, refresh=False):
+        try:
+            self.load(refresh=refresh)
+        except Exception as e:
+            print >> sys.stderr, 'load failed: %s' % e
+        while not self.stopped.wait(self.refresh_interval):
+            try:
+                self.load(refresh=True)
+            except Exception as e:
+                # keep serving the old index
+                print >> sys.stderr, 'refresh failed: %s' % e
+
+    def shutdown(self):
+        self.stopped.set()
+        HTTPServer.shutdown(self)
+
+def serve(host='127.0.0.1', port=8080, refresh_interval=3600, verbose=False, refresh=False, source=None):
+    server = FreeRoomsServer((host, port), refresh_interval=refresh_interval, verbose=verbose, source=source)
+    server.start_refresher(refresh)
+    print >> sys.stderr, 'serving on http://%s:%d' % server.server_address
+    try:
+        server.serve_forever()
+    finally:
+        server.stopped.set()
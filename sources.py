@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import re
+
+from collections import OrderedDict
+
+import instrument
+from extract import parse_table
+from fetch import fetch
+
+# the endpoints rooms can be crawled from. a source lists the requests of a
+# full crawl (as crawl.Crawler tasks) and the parser for its pages, which
+# is module level so it can also run in a worker process. see pipeline.py.
+
+###################################################################################
+# yednew.dll: a POST per department batch, filtered by semester/day/hour
+
+YEDNEW_URL = 'http://yedion.tau.ac.il/yed/yednew.dll'
+YEDNEW_COLUMNS = dict(semester=0, day=2, room=3, building=4)
+
+def gen_request_data(semester, day, hour):
+    data = OrderedDict([
+        ('MfcISAPICommand', 'but'),
+        ('year',''),
+        ('semester',semester),
+        ('hour',hour),
+        ('yom',day),
+        ('department1','08'), # all art
+        ('department2','05'), # all engineering
+        ('department3','10'), # all social
+        ('department4','04'), # all life
+        ('department5','06'), # all humanities
+        ('department6','03'), # all exact
+        ('department7','14'), # all law
+        ('course_nam',''),
+        ('teach_nam',''),
+        ('department8','12'), # all management
+        ('department9','01'), # all medicine
+        ('department10','11'), # social work (others needed)
+        ('department11','21712172'), # english + foreign languages
+        ('department12','188018821883'), # all whatever this is
+        ('department13','1843'), # all cyber
+    ])
+    if not semester:
+        data.pop('semester')
+    if not day:
+        data.pop('yom')
+    if not hour:
+        data.pop('hour')
+    yield data
+    # clear deps
+    for key in data.keys():
+        if key.startswith('department'):
+            data[key] = ''
+    additional_dep10 = ['11', '07', '09', '15']
+    for dep10 in additional_dep10:
+        data['department10'] = dep10
+        yield data
+
+@instrument.timed('minify')
+def minify(response):
+    response = response.replace('<A ', '<a ').replace('</A>', '</a>').replace('&nbsp;','').replace('\n','')
+    response = re.sub('<a [\s\S]*?</a>', '', response)
+    response = re.sub('<img [\s\S]*?>', '', response)
+    response = re.sub('<th [\s\S]*?</th>', '', response)
+    response = re.sub('colspan=".*?"', '', response)
+    response = re.sub('class=".*?"', '', response)
+    response = re.sub('bgcolor=".*?"', '', response)
+    response = response.replace('align="right"','').replace('dir="rtl"','').replace('align ="right"','')
+    response = response.replace('  ',' ')
+    return response
+
+@instrument.timed('parse')
+def parse_yednew(response, fast=None):
+    # raw page in, (building, room, day, hours, semester) rows out
+    return parse_table(response, YEDNEW_COLUMNS, fast)
+
+###################################################################################
+# syllabus: a GET per department, departments listed on the yedion page
+
+DEPS_URL = 'http://www20.tau.ac.il/yedion/yedion.html'
+SYLLABUS_URL = 'http://www2.tau.ac.il/yedion/syllabus/?deployment=10&dep=%s'
+SYLLABUS_COLUMNS = dict(building=2, room=3, day=4, semester=6)
+
+_OPTION_VALUE = re.compile(r'<option\b[^>]*?\bvalue\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.I)
+
+def split_in_n(x, n):
+    return [x[i:i+n] for i in range(0, len(x), n)]
+
+def get_deps():
+    # the 4 digit department codes packed into the <option> values of the
+    # index page, sorted. scanned with a regex, no need for a whole soup.
+    deps = set()
+    for match in _OPTION_VALUE.finditer(fetch(DEPS_URL) or ''):
+        value = ''.join(match.groups(''))
+        deps.update(d for d in split_in_n(value, 4) if len(d) == 4)
+    return sorted(deps)
+
+@instrument.timed('parse')
+def parse_syllabus(response, fast=None):
+    return parse_table(response, SYLLABUS_COLUMNS, fast)
+
+###################################################################################
+# sources
+
+class Source(object):
+
+    name = None
+    parse_processes = 0 # see crawl.Crawler
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def tasks(self):
+        raise NotImplementedError
+
+class YednewSource(Source):
+    # a handful of big pages, parsed in threads
+
+    name = 'yednew'
+
+    def __init__(self, semester='', day='', hour=''):
+        Source.__init__(self, parse_yednew)
+        self.semester = semester
+        self.day = day
+        self.hour = hour
+
+    def tasks(self):
+        return [
+            (YEDNEW_URL, dict(data=OrderedDict(data), post=True, processor=minify))
+            for data in gen_request_data(semester=self.semester, day=self.day, hour=self.hour)
+        ]
+
+class SyllabusSource(Source):
+    # hundreds of small pages, parsed in processes
+
+    name = 'syllabus'
+
+    def __init__(self):
+        from multiprocessing import cpu_count
+        Source.__init__(self, parse_syllabus)
+        self.parse_processes = cpu_count()
+
+    def tasks(self):
+        return [SYLLABUS_URL % dep for dep in get_deps()]
+
+SOURCES = OrderedDict((source.name, source) for source in (YednewSource, SyllabusSource))
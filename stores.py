@@ -0,0 +1,375 @@
+import json
+import os
+import socket
+import sys
+import time
+import urlparse
+
+from collections import namedtuple
+from SocketServer import StreamRequestHandler, ThreadingTCPServer
+from threading import Lock, local
+
+# backends for the fetch cache (see fetch.py, which also has the local
+# directory one). a store keeps, per key, an Entry and the entry's data as
+# stored (maybe compressed); fetch does the encoding and the freshness
+# checks, so a store only has to hold on to them.
+#
+#   sqlite: one database file, which processes on a host can share
+#   redis:  any server speaking the redis protocol, which hosts can share.
+#           `python stores.py` runs a small in-memory stand-in for it.
+#
+# store errors (a lost connection, a locked database) are StoreErrors, and
+# fetch treats them as cache misses.
+
+# name and offset are where the local store keeps the data; other stores
+# leave them '' and -1
+Entry = namedtuple('Entry', 'name stored ttl size etag modified digest codec offset')
+
+class StoreError(IOError):
+    pass
+
+def _entry(stored, ttl, size, etag, modified, digest, codec):
+    # sqlite and json hand the strings back as unicode
+    return Entry('', stored, ttl, size, str(etag), str(modified), str(digest), str(codec), -1)
+
+class Store(object):
+
+    name = None
+
+    def get(self, key):
+        # the entry, fresh or not, or None if the store has no data for it
+        raise NotImplementedError
+
+    def read(self, key, e):
+        # the stored data of the entry
+        raise NotImplementedError
+
+    def put(self, key, data, ttl, etag, modified, digest, codec):
+        # stores the data and returns its new entry
+        raise NotImplementedError
+
+    def renew(self, key, e, ttl):
+        # restarts the entry's ttl (after a 304), returns the new entry
+        raise NotImplementedError
+
+    def drop(self, key, e):
+        # forgets the entry (its data is unreadable)
+        raise NotImplementedError
+
+    def evict(self, max_bytes, grace):
+        # drops the entries past use: expired, and with validators, expired
+        # more than grace seconds ago. then, unless max_bytes is None, least
+        # recently used ones until the store fits in it. returns the number
+        # of evicted entries.
+        return 0
+
+    def total_bytes(self):
+        # roughly; fetch evicts when it is over cache_max_bytes
+        return 0
+
+def _per_process(f):
+    # connections are per thread, and reopened in a forked child
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = self.local.conn = f(self)
+            self.local.pid = os.getpid()
+        return conn
+    return connection
+
+#######################################################################
+# sqlite
+
+class SqliteStore(Store):
+
+    name = 'sqlite'
+
+    SCHEMA = '''
+        create table if not exists entries (
+            key text primary key, stored real, ttl real, size integer, etag text,
+            modified text, digest text, codec text, used real, data blob
+        );
+        create index if not exists entries_used on entries (used);
+    '''
+
+    def __init__(self, path='.cache.sqlite', timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.local = local()
+        self.lock = Lock()
+        self.ready = False
+        self.total = None
+
+    @_per_process
+    def connection(self):
+        import sqlite3
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        with self.lock:
+            # once, as threads creating the table at once trip each other up
+            if not self.ready:
+                conn.execute('pragma journal_mode=wal') # readers don't wait for writers
+                conn.executescript(self.SCHEMA)
+                self.ready = True
+        return conn
+
+    def execute(self, query, *args):
+        # returns the number of rows changed
+        return self.run(lambda conn: conn.execute(query, args).rowcount)
+
+    def select(self, query, *args):
+        return self.run(lambda conn: conn.execute(query, args).fetchall())
+
+    def run(self, f):
+        # any sqlite error (say, "database is locked") is a StoreError
+        import sqlite3
+        try:
+            return f(self.connection())
+        except sqlite3.Error as e:
+            raise StoreError('sqlite: %s' % e)
+
+    def get(self, key):
+        rows = self.select('select stored, ttl, size, etag, modified, digest, codec from entries where key = ?', key)
+        if rows:
+            return _entry(*rows[0])
+
+    def read(self, key, e):
+        rows = self.select('select data from entries where key = ?', key)
+        if not rows:
+            raise StoreError('sqlite: %s was evicted' % key)
+        try:
+            self.run(lambda conn: self.touch(conn, key))
+        except StoreError:
+            pass # only the lru order, not worth the data already read
+        return str(rows[0][0])
+
+    def touch(self, conn, key):
+        # the lru update waits for no writer: while another connection holds
+        # the write lock, it is skipped
+        timeout = conn.execute('pragma busy_timeout').fetchone()[0]
+        conn.execute('pragma busy_timeout = 0')
+        try:
+            conn.execute('update entries set used = ? where key = ?', (time.time(), key))
+        finally:
+            conn.execute('pragma busy_timeout = %d' % timeout)
+
+    def put(self, key, data, ttl, etag, modified, digest, codec):
+        e = Entry('', time.time(), ttl, len(data), etag or '', modified or '', digest, codec, -1)
+        self.execute(
+            'insert or replace into entries values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            key, e.stored, e.ttl, e.size, e.etag, e.modified, e.digest, e.codec, e.stored, buffer(data),
+        )
+        with self.lock:
+            if self.total is not None:
+                self.total += e.size
+        return e
+
+    def renew(self, key, e, ttl):
+        e = e._replace(stored=time.time(), ttl=ttl)
+        self.execute('update entries set stored = ?, ttl = ?, used = ? where key = ?', e.stored, e.ttl, e.stored, key)
+        return e
+
+    def drop(self, key, e):
+        self.execute('delete from entries where key = ?', key)
+
+    def evict(self, max_bytes, grace):
+        evicted = self.execute(
+            "delete from entries where stored + ttl + (case when etag != '' or modified != '' then ? else 0 end) <= ?",
+            grace, time.time(),
+        )
+        total = self.select('select coalesce(sum(size), 0) from entries')[0][0]
+        drop = []
+        if max_bytes is not None and total > max_bytes:
+            for key, size in self.select('select key, size from entries order by used'):
+                if total <= max_bytes:
+                    break
+                drop.append((key,))
+                total -= size
+            self.run(lambda conn: conn.executemany('delete from entries where key = ?', drop))
+        self.total = total
+        return evicted + len(drop)
+
+    def total_bytes(self):
+        if self.total is None:
+            self.total = self.select('select coalesce(sum(size), 0) from entries')[0][0]
+        return self.total
+
+#######################################################################
+# redis protocol
+
+def read_reply(f):
+    # one reply (or, on the server side, one command) off the stream
+    line = f.readline()
+    if not line.endswith('\r\n'):
+        raise socket.error('connection closed')
+    kind, rest = line[0], line[1:-2]
+    if kind == '+':
+        return rest
+    if kind == '-':
+        raise StoreError(rest)
+    if kind == ':':
+        return int(rest)
+    if kind == '$':
+        n = int(rest)
+        return None if n < 0 else f.read(n + 2)[:-2]
+    if kind == '*':
+        n = int(rest)
+        return None if n < 0 else [read_reply(f) for _ in xrange(n)]
+    raise StoreError('bad reply: %r' % line)
+
+def encode(value):
+    # None, an int, a string (as a bulk string) or a list of them
+    if value is None:
+        return '$-1\r\n'
+    if isinstance(value, (int, long)):
+        return ':%d\r\n' % value
+    if isinstance(value, list):
+        return '*%d\r\n%s' % (len(value), ''.join(encode(v) for v in value))
+    value = str(value)
+    return '$%d\r\n%s\r\n' % (len(value), value)
+
+class RedisConnection(object):
+
+    def __init__(self, host, port, db=0, password=None, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.file = self.sock.makefile('rb')
+        if password:
+            self.call('AUTH', password)
+        if db:
+            self.call('SELECT', db)
+
+    def call(self, *args):
+        self.sock.sendall(encode([str(arg) for arg in args]))
+        return read_reply(self.file)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+class RedisStore(Store):
+    # an entry is a hash with its metadata (as json) and data. the server
+    # bounds its memory itself (say, maxmemory-policy allkeys-lru), so evict
+    # does nothing; expired entries are left for it, and for revalidation.
+
+    name = 'redis'
+
+    def __init__(self, url='redis://127.0.0.1:6379/0', prefix='gilman:', timeout=5):
+        url = urlparse.urlparse(url)
+        self.host = url.hostname or '127.0.0.1'
+        self.port = url.port or 6379
+        self.db = int(url.path.strip('/') or 0)
+        self.password = url.password
+        self.prefix = prefix
+        self.timeout = timeout
+        self.local = local()
+
+    @_per_process
+    def connection(self):
+        try:
+            return RedisConnection(self.host, self.port, self.db, self.password, self.timeout)
+        except socket.error as e:
+            raise StoreError('redis %s:%d: %s' % (self.host, self.port, e))
+
+    def call(self, *args):
+        try:
+            return self.connection().call(*args)
+        except socket.error as e:
+            # reconnect on the next call
+            if getattr(self.local, 'conn', None):
+                self.local.conn.close()
+                self.local.conn = None
+            raise StoreError('redis %s:%d: %s' % (self.host, self.port, e))
+
+    def get(self, key):
+        meta = self.call('HGET', self.prefix + key, 'meta')
+        if meta:
+            return _entry(*json.loads(meta))
+
+    def read(self, key, e):
+        data = self.call('HGET', self.prefix + key, 'data')
+        if data is None:
+            raise StoreError('redis: %s was evicted' % key)
+        return data
+
+    def _meta(self, e):
+        return json.dumps([e.stored, e.ttl, e.size, e.etag, e.modified, e.digest, e.codec])
+
+    def put(self, key, data, ttl, etag, modified, digest, codec):
+        e = Entry('', time.time(), ttl, len(data), etag or '', modified or '', digest, codec, -1)
+        self.call('HSET', self.prefix + key, 'meta', self._meta(e), 'data', data)
+        return e
+
+    def renew(self, key, e, ttl):
+        e = e._replace(stored=time.time(), ttl=ttl)
+        self.call('HSET', self.prefix + key, 'meta', self._meta(e))
+        return e
+
+    def drop(self, key, e):
+        self.call('DEL', self.prefix + key)
+
+#######################################################################
+# stand-in server
+#
+# enough of the redis protocol for RedisStore, kept in memory: for trying a
+# shared cache out, or sharing one between the processes of a sharded crawl
+# without a real server. python stores.py [host] [port]
+
+class StandInHandler(StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                command = read_reply(self.rfile)
+            except (StoreError, socket.error):
+                return
+            if not isinstance(command, list) or not command:
+                return
+            try:
+                reply = self.server.run(command[0].upper(), command[1:])
+            except (StoreError, KeyError, IndexError, ValueError) as e:
+                reply = '-ERR %s\r\n' % (e or 'wrong arguments')
+            self.wfile.write(reply)
+            if command[0].upper() == 'QUIT':
+                return
+
+class StandInServer(ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        ThreadingTCPServer.__init__(self, address, StandInHandler)
+        self.lock = Lock()
+        self.data = {} # key -> field -> value
+
+    def run(self, command, args):
+        with self.lock:
+            if command in ('PING', 'SELECT', 'AUTH', 'QUIT'):
+                return '+OK\r\n' if command != 'PING' else '+PONG\r\n'
+            if command == 'HGET':
+                return encode(self.data.get(args[0], {}).get(args[1]))
+            if command == 'HSET':
+                fields = self.data.setdefault(args[0], {})
+                added = len([k for k in args[1::2] if k not in fields])
+                fields.update(zip(args[1::2], args[2::2]))
+                return encode(added)
+            if command == 'DEL':
+                return encode(len([self.data.pop(k) for k in args if k in self.data]))
+            if command == 'EXISTS':
+                return encode(len([k for k in args if k in self.data]))
+            if command == 'DBSIZE':
+                return encode(len(self.data))
+            if command == 'FLUSHDB':
+                self.data.clear()
+                return '+OK\r\n'
+            raise StoreError("unknown command '%s'" % command)
+
+def serve(host='127.0.0.1', port=6379):
+    server = StandInServer((host, port))
+    print >> sys.stderr, 'redis stand-in on %s:%d' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    serve(sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1', int(sys.argv[2]) if len(sys.argv) > 2 else 6379)
@@ -0,0 +1,63 @@
+import sys
+
+# menu helpers shared by the interactive front ends (main.py, old.py)
+
+QUIT_STRING = '\\q'
+
+def sorted_heb(slist):
+    return sorted(slist)
+
+def nice_hour(h):
+    return '%02d:00' % h
+
+def print_and_select_from_list(msg, lst, printer=None):
+    print_list(lst, printer)
+    return select_from_list(msg, lst, printer)
+
+def print_list(lst, printer=None):
+    i = 1
+    for item in lst:
+        item_str = printer(item) if printer else item
+        print_item(i, item_str)
+        i += 1
+
+def print_item(i, item):
+    print '%s. %s' % (i, item)
+
+def select_from_list(msg, lst, printer=None):
+    while True:
+        try:
+            inp = read_input(msg + ' (1-' + str(len(lst)) + ')')
+            if not inp:
+                return
+            choice = int(inp) - 1
+            if choice < 0:
+                raise IndexError
+            selection = lst[choice]
+            print '---'
+            print 'selected:', printer(selection) if printer else selection
+            print '---'
+            return selection
+        except ValueError:
+            print 'invalid input'
+        except IndexError:
+            print 'out of range'
+
+def read_input(msg):
+    import readline # line editing for raw_input, loaded with the first prompt
+    inp = raw_input("%s: " % msg)
+    if not inp:
+        print 'cancelled.'
+    elif inp == QUIT_STRING:
+        sys.exit(0)
+    return inp
+
+def yesno(msg):
+    inp = None
+    y = ['y', 'yes', 'yy', 'yyy', 'ye', 'yea', 'yeah', '']
+    n = ['n', 'no', 'nn', 'nnn','nah', 'nope', 'sorry']
+    while inp not in y + n:
+        inp = raw_input(msg + ' ([y]/n) ').lower()
+        if inp == QUIT_STRING:
+            sys.exit(0)
+    return inp in y